@@ -1,19 +1,29 @@
 # Imports and Global Variables
-from dash import Dash, dcc, html, Input, Output, callback_context
+import functools
+import hashlib
+import os
+
+from dash import ClientsideFunction, Dash, dcc, html, Input, Output, Patch, State, callback_context
+from dash.exceptions import PreventUpdate
+from flask import jsonify, request
 from plotly.subplots import make_subplots
 import dash_bootstrap_components as dbc
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 
+from callback_metrics import CallbackMetrics, WorkerStats, server_timing
+from figure_cache import FigureCache, SharedFigureStore
+from figure_payload import compact_figure, compact_trace
+from module_data import cache_dir, checklist_options, legendgroupdict, source_files, transmission_bins
+from scenario_store import open_data_store
+
 # Import Existing Data
-generation_df = pd.read_csv('ModuleData/electricity_generation.csv')
-capacity_df = pd.read_csv('ModuleData/existing_and_new_capacity.csv')
-costs_lineplot = pd.read_csv('ModuleData/costs_lineplot.csv')
-emissions_lineplot = pd.read_csv('ModuleData/emissions_lineplot.csv')
-df_nbuilt_hydro = pd.read_csv('ModuleData/df_nbuilt_hydro.csv')
-df_nbuilt_vre = pd.read_csv('ModuleData/df_nbuilt_vre.csv')
-df_nbuilt_fossil = pd.read_csv('ModuleData/df_nbuilt_fossil.csv')
-map_df = pd.read_csv('ModuleData/transmission_map_data.csv')
+# The prepared tables (see module_data.py) are reached through a data store (see scenario_store.py), which the
+# callbacks ask for the rows of the selected scenarios only. Its calls are timed as the 'data' phase of the callbacks.
+callback_metrics = CallbackMetrics()
+loaded_data = open_data_store()
+data_store = callback_metrics.timed(loaded_data, 'data')
 
 # Colors
 coal_color = '#343a40'
@@ -28,53 +38,118 @@ pstorage_color = '#6a96ac'
 trans_color = '#656d4a'
 curtailment_color = '#c94f39'
 
-# Checklist Options
-checklist_options = ['Static Costs', 'Existing Tx', 'Planned Tx', 'Reference', 'Coal Ret. 55y',
-                     'Coal Ret. 45y', 'Clean 80%']
-
-# Data transformation for country bar plots
-df_nbuilt = df_nbuilt_hydro.merge(
-    df_nbuilt_vre, on=['load_zone', 'Scenario'], how='left').merge(
-    df_nbuilt_fossil, on=['load_zone', 'Scenario'], how='left')[
-    ['load_zone', 'Scenario', 'Hydro', 'Wind', 'SolarPV', 'SolarCSP', 'Battery', 'Coal', 'Gas']]
-df_nbuilt = df_nbuilt.replace({'Optimal Tx (Reference)': 'Reference', 'Static costs': 'Static Costs',
-                               'Coal ret. 55y': 'Coal Ret. 55y', 'Coal ret. 45y': 'Coal Ret. 45y'})
-
-# Dictionary for transmission maps
-legendgroupdict = {0: {'name': 'none', 'width': 0},
-                   1: {'name': '1 - 100', 'width': 2},
-                   2: {'name': '101 - 1000', 'width': 3},
-                   3: {'name': '1001 - 2000', 'width': 4},
-                   4: {'name': '2001 - 4000', 'width': 6},
-                   5: {'name': '4001 - 6042', 'width': 8}}
-
-# Data transformation for transmission maps
-map_df['Existing Tx'] = map_df['Existing']
-for scenario in checklist_options:
-    legendgroup = []
-    for row in range(map_df.shape[0]):
-        if map_df.loc[row, scenario] == 0:
-            legendgroup.append(0)
-        elif (map_df.loc[row, scenario] >= 1) & (map_df.loc[row, scenario] <= 100):
-            legendgroup.append(1)
-        elif (map_df.loc[row, scenario] > 100) & (map_df.loc[row, scenario] <= 1000):
-            legendgroup.append(2)
-        elif (map_df.loc[row, scenario] > 1000) & (map_df.loc[row, scenario] <= 2000):
-            legendgroup.append(3)
-        elif (map_df.loc[row, scenario] > 2000) & (map_df.loc[row, scenario] <= 4000):
-            legendgroup.append(4)
-        else:
-            legendgroup.append(5)
-    map_df[scenario + '_legendgroup'] = legendgroup
+# Decimal places kept in the figures sent to the browser, per metric. Rounding also flushes float noise (values like
+# 6.46e-15 in the generation data) to zero.
+figure_precision = {'capacity': 3, 'generation': 3, 'costs': 2, 'emissions': 2, 'countries': 3, 'coordinates': 4}
+
+# Scenario filtering mode: 'server' rebuilds figures in the callbacks, 'client' ships every figure to the browser once
+# and filters them there, so toggling scenarios never reaches the server
+filtering_mode = os.environ.get('CETLAB_FILTERING', 'server')
+
+# Country new-build chart: the load zones are ranked by their new capacity and shown a page at a time, with the zones
+# ranked below the page summed into one 'Other' bar. Above webgl_bar_limit bars (zones on the page times selected
+# scenarios, so a large page or a study with many scenarios) the chart is drawn with WebGL instead of as a bar chart.
+country_page_sizes = [10, 20, 50]
+country_page_size = 20
+webgl_bar_limit = 400
+# The zones are kept in the order of the data ('Unranked') when they all fit on the default page, and ranked by their
+# new capacity of all technologies when they don't
+country_rank = ('Unranked' if loaded_data.new_builds(checklist_options)['load_zone'].nunique() <= country_page_size
+                else 'Total')
+
+
+def normalize_selection(selection):
+    # Put a checklist selection in checklist order and drop duplicates, so equivalent selections share a cache entry
+    return [option for option in checklist_options if option in selection]
+
+
+# Figure cache, keyed by callback and normalized selection (at most 2^7 selections per callback)
+# With CETLAB_FIGURE_CACHE=shared (the default of wsgi.py) the figures are also stored in an SQLite file that every
+# worker process of the app shares, so each selection is only built once for all of them
+if os.environ.get('CETLAB_FIGURE_CACHE', 'local') == 'shared':
+    shared_figures = SharedFigureStore(os.environ.get('CETLAB_FIGURE_CACHE_PATH',
+                                                      os.path.join(cache_dir, 'figures.sqlite')))
+else:
+    shared_figures = None
+# The version of a callback's entries is that of the csv files its figures were made from, as they were loaded
+figure_cache = FigureCache(maxsize=512, ttl=24 * 60 * 60, normalize=normalize_selection, version=loaded_data.version,
+                           shared=shared_figures)
+
+# Prepared tables and csv files the figures of each callback are made from
+figure_frames = {'generation': ['capacity_df', 'generation_df', 'costs_lineplot', 'emissions_lineplot'],
+                 'countries': ['df_nbuilt'],
+                 'transmission_maps': ['map_df']}
+figure_sources = {name: source_files(*frames) for name, frames in figure_frames.items()}
+
+
+def data_version(name):
+    # Short fingerprint of the csv files behind a callback's figures, stored in the browser with the rendered selection
+    return hashlib.sha1(repr(figure_cache.version(figure_sources[name])).encode()).hexdigest()
+
 
 # Dash Application Layout
 app = Dash(__name__, external_stylesheets=[dbc.themes.SANDSTONE])
 
+
+# Each worker process of the app keeps its own counters for the endpoints below. With CETLAB_WORKER_STATS=shared (the
+# default of wsgi.py) every worker also writes them to an SQLite file once a second, and the endpoints add up the
+# counters of all workers, so they give the same totals whichever worker answers.
+if os.environ.get('CETLAB_WORKER_STATS', 'local') == 'shared':
+    worker_stats = WorkerStats(os.environ.get('CETLAB_WORKER_STATS_PATH', os.path.join(cache_dir, 'workers.sqlite')))
+else:
+    worker_stats = None
+
+
+def other_workers(part):
+    return worker_stats.others(part) if worker_stats is not None else []
+
+
+def worker_snapshot():
+    return {'metrics': callback_metrics.snapshot(), 'figure_cache': figure_cache.snapshot()}
+
+
+# Started by the first request of every process, like the watcher of the ModuleData files
+@app.server.before_request
+def publish_worker_stats():
+    if worker_stats is not None:
+        worker_stats.start(1.0, worker_snapshot)
+
+
+# Hit/miss counters of the figure cache, to confirm it is working in production
+@app.server.route('/figure-cache')
+def figure_cache_stats():
+    return jsonify(figure_cache.stats(other_workers('figure_cache')))
+
+
+# Time of each callback request, split into data, figure and serialization phases. The phases are sent back in a
+# Server-Timing header, and the histograms of every callback are on the /metrics endpoint (Prometheus text format).
+@app.server.before_request
+def start_callback_timing():
+    if request.path.endswith('/_dash-update-component'):
+        callback_metrics.begin()
+
+
+@app.server.after_request
+def record_callback_timing(response):
+    if request.path.endswith('/_dash-update-component'):
+        timings = callback_metrics.end(response.status_code, response.content_length or 0,
+                                       (request.get_json(silent=True, cache=True) or {}).get('output'))
+        if timings is not None:
+            response.headers['Server-Timing'] = server_timing(timings)
+    return response
+
+
+@app.server.route('/metrics')
+def metrics():
+    return callback_metrics.render(other_workers('metrics')), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 app.layout = dbc.Container([
     html.Br(), html.Br(),
-    dcc.Tabs([
+    # The value of the tabs is the tab that is open, the figure callbacks only draw the figures of that tab
+    dcc.Tabs(id='tabs', value='overview', children=[
         # Overview Tab
-        dcc.Tab(label='Overview', children=[
+        dcc.Tab(label='Overview', value='overview', children=[
             html.Div([
                 html.Br(),
                 html.P('This module provides readers with a way to interact and explore the results from this research.\
@@ -89,7 +164,7 @@ app.layout = dbc.Container([
             ]),
         ]),
         # Future New Capacity and Cost tab
-        dcc.Tab(label='Future New Capacity and Cost', children=[
+        dcc.Tab(label='Future New Capacity and Cost', value='generation', children=[
             html.Br(),
             html.Center(html.P('Scenario Selection', style={'font-weight': 'bold', 'font-size': 20}
                    )),
@@ -112,7 +187,7 @@ app.layout = dbc.Container([
             ))
         ]),
         # Country New-Build Capacity tab
-        dcc.Tab(label='Country New-Build Capacity', children=[
+        dcc.Tab(label='Country New-Build Capacity', value='countries', children=[
             html.Br(),
             html.Center(html.P('Scenario Selection', style={'font-weight': 'bold', 'font-size': 20}
                                )),
@@ -124,13 +199,35 @@ app.layout = dbc.Container([
                           style={'textAlign': 'center'}
                           ),
             html.Br(),
+            # Ranking and paging of the load zones (server mode only, client mode shows the first page)
+            html.Div(id='country_controls', style={'display': 'none'} if filtering_mode == 'client' else {}, children=[
+                dbc.Row([
+                    dbc.Col(html.P('Rank zones by', style={'font-weight': 'bold', 'textAlign': 'right'}), width=2),
+                    dbc.Col(dcc.Dropdown(id='country_rank', clearable=False, value=country_rank,
+                                         options=[{'label': 'Unranked (data order)', 'value': 'Unranked'},
+                                                  {'label': 'All technologies', 'value': 'Total'},
+                                                  {'label': 'Wind', 'value': 'Wind'},
+                                                  {'label': 'Solar', 'value': 'SolarPV'},
+                                                  {'label': 'Battery', 'value': 'Battery'},
+                                                  {'label': 'Coal', 'value': 'Coal'},
+                                                  {'label': 'Gas', 'value': 'Gas'},
+                                                  {'label': 'Hydro', 'value': 'Hydro'}]), width=3),
+                    dbc.Col(html.P('Zones per page', style={'font-weight': 'bold', 'textAlign': 'right'}), width=2),
+                    dbc.Col(dcc.Dropdown(id='country_page_size', clearable=False, value=country_page_size,
+                                         options=[{'label': str(size), 'value': size} for size in country_page_sizes] +
+                                                 [{'label': 'All', 'value': 0}]), width=2)
+                ], justify='center'),
+                html.Center(html.Div(id='country_pager', style={'display': 'none'}, children=[
+                    dbc.Pagination(id='country_page', max_value=1, active_page=1, fully_expanded=False)
+                ]))
+            ]),
             html.Center(dcc.Graph(
                 id='countries_barplot_combined'  # New Built Capacities by Country bar plot
             )),
             html.Br()
         ]),
         # Transmission maps tab
-        dcc.Tab(label='Transmission Capacities', children=[
+        dcc.Tab(label='Transmission Capacities', value='transmission_maps', children=[
             html.Br(),
             html.Center(html.P('Scenario Selection', style={'font-weight': 'bold', 'font-size': 20}
                                )),
@@ -152,23 +249,187 @@ app.layout = dbc.Container([
 
 # End of module layout code
 
+# Traces
+# The bar plots have one trace per bar type, with the bars of every selected scenario. A scenario is added to or
+# removed from a bar plot that is already displayed by replacing the x and y arrays of its traces. The line plots and
+# maps are made of one block of traces per selected scenario, in selection order (plus the map legend markers at the
+# end), and a scenario is added or removed by inserting or deleting its block, without touching the other scenarios.
+
+# Bar types of the bar plots: the column each one is drawn from and its trace properties
+existing_capacity = dict(marker_pattern_shape="x", legendgroup='1', showlegend=False, marker_line_width=0)
+capacity_bars = [
+    # Existing gen capacity
+    ('Coal', dict(name='Coal existing', marker_color=coal_color, **existing_capacity)),
+    ('Gas', dict(name='Gas existing', marker_color=gas_color, **existing_capacity)),
+    ('Hydro', dict(name='Hydro existing', marker_color=hydro_color, **existing_capacity)),
+    ('Solar', dict(name='Solar existing', marker_color=solar_color, **existing_capacity)),
+    ('Wind', dict(name='Wind existing', marker_color=wind_color, **existing_capacity)),
+    ('Nuclear', dict(name='Nuclear existing', marker_color=nuclear_color, **existing_capacity)),
+    ('Other', dict(name='Other existing', marker_color=other_color, **existing_capacity)),
+    ('PStorage', dict(name='Pumped storage<br>existing', marker_color=pstorage_color, **existing_capacity)),
+    # New gen capacity
+    ('Coal_new', dict(name='Coal new', marker_color=coal_color, marker_line_width=0)),
+    ('Gas_new', dict(name='Gas new', marker_color=gas_color, marker_line_width=0)),
+    ('Hydro_new', dict(name='Hydro new', marker_color=hydro_color, marker_line_width=0)),
+    ('Solar_new', dict(name='Solar new', marker_color=solar_color, marker_line_width=0)),
+    ('Wind_new', dict(name='Wind new', marker_color=wind_color, marker_line_width=0)),
+    ('Other_new', dict(name='Other new', marker_color=other_color, marker_line_width=0)),
+    ('Battery', dict(name='Battery new', marker_color=battery_color, marker_line_width=0)),
+    # Adding dummy markers
+    ('dummy_existing', dict(name='Existing<br> capacity', marker_color='white', marker_pattern_shape="x",
+                            legendgroup='1', showlegend=True, marker_line_width=0))]
+
+# Remove white lines separating elements of bars
+generation_bars = [
+    ('Trans_loss', dict(name='Transmission <br>loss', marker_color=trans_color, marker_line_width=0)),
+    ('PStorage', dict(name='Pumped <br>storage', marker_color=pstorage_color, marker_line_width=0)),
+    ('Battery', dict(name='Battery', marker_color=battery_color, marker_line_width=0)),
+    ('Coal', dict(name='Coal', marker_color=coal_color, marker_line_width=0)),
+    ('Gas', dict(name='Gas', marker_color=gas_color, marker_line_width=0)),
+    ('Nuclear', dict(name='Nuclear', marker_color=nuclear_color, marker_line_width=0)),
+    ('Hydro', dict(name='Hydro', marker_color=hydro_color, marker_line_width=0)),
+    ('Solar', dict(name='Solar', marker_color=solar_color, marker_line_width=0)),
+    ('Wind', dict(name='Wind', marker_color=wind_color, marker_line_width=0)),
+    ('Other', dict(name='Other', marker_color=other_color, marker_line_width=0)),
+    ('Curtailment', dict(name='Curtailment', marker_color=curtailment_color, marker_line_width=0))]
+
+country_bars = [
+    ('Wind', dict(name='Wind', marker_color=wind_color)),
+    ('SolarPV', dict(name='Solar', marker_color=solar_color)),
+    ('Battery', dict(name='Battery', marker_color=battery_color)),
+    ('Coal', dict(name='Coal', marker_color=coal_color)),
+    ('Gas', dict(name='Gas', marker_color=gas_color)),
+    ('Hydro', dict(name='Hydro', marker_color=hydro_color))]
+
+# Line styles of the costs and emissions plots
+line_style_dict = {'Static Costs': {'Color': '#e09f3e', 'Dash': 'solid', 'Legend Group': '0'},
+                   'Existing Tx': {'Color': '#90be6d', 'Dash': 'dash', 'Legend Group': '1'},
+                   'Planned Tx': {'Color': '#4d908e', 'Dash': 'dash', 'Legend Group': '2'},
+                   'Reference': {'Color': '#766A00', 'Dash': 'solid', 'Legend Group': '3'},
+                   'Coal Ret. 55y': {'Color': '#343a40', 'Dash': 'dashdot', 'Legend Group': '4'},
+                   'Coal Ret. 45y': {'Color': '#766A00', 'Dash': 'dashdot', 'Legend Group': '5'},
+                   'Clean 80%': {'Color': '#277da1', 'Dash': 'dot', 'Legend Group': '6'}}
+
+
+def bar_data(rows, bars, x_columns):
+    # x and y arrays of every bar type, with the selected scenarios as the second level of the x axis
+    # Flip the order of x_columns to flip the year vs scenario grouping
+    x = [rows[x_columns[0]].to_numpy(), rows[x_columns[1]].to_numpy()]
+    return [{'x': x, 'y': rows[column].to_numpy()} for column, style in bars]
+
+
+def bar_traces(rows, bars, x_columns):
+    return [go.Bar(**data, **style) for data, (column, style) in zip(bar_data(rows, bars, x_columns), bars)]
+
+
+def line_block(costs_lineplot, emissions_lineplot, selected):
+    # Costs line in the left subplot, emissions line in the right one
+    return [go.Scatter(x=costs_lineplot['period'], y=costs_lineplot[selected], name=selected,
+                       legendgroup=line_style_dict[selected]['Legend Group'],
+                       line=dict(color=line_style_dict[selected]['Color'],
+                                 dash=line_style_dict[selected]['Dash']), xaxis='x', yaxis='y'),
+            go.Scatter(x=emissions_lineplot['period'], y=emissions_lineplot[selected], name=selected,
+                       legendgroup=line_style_dict[selected]['Legend Group'], showlegend=False,
+                       line=dict(color=line_style_dict[selected]['Color'],
+                                 dash=line_style_dict[selected]['Dash']), xaxis='x2', yaxis='y2')]
+
+
+def map_subplot(position):
+    # Subplots are numbered row by row: 'mapbox', 'mapbox2', 'mapbox3', ...
+    return {'subplot': 'mapbox' if position == 0 else 'mapbox{}'.format(position + 1)}
+
+
+def map_block(scenario_lines, position):
+    # One trace per magnitude range (empty if no line falls into it), so every scenario has the same number of traces
+    # All lines of the same magnitude in a subplot are drawn as a single trace, with a gap between lines
+    legend_groups = scenario_lines['legendgroup'].to_numpy()
+    traces = []
+    for legend_group in transmission_bins.index:
+        lon, lat = line_segments(scenario_lines[legend_groups == legend_group])
+        traces.append(go.Scattermapbox(
+            mode="markers+lines",
+            lon=lon,
+            lat=lat,
+            name=legendgroupdict[legend_group]['name'],
+            legendgroup=int(legend_group),
+            showlegend=False,
+            line={'width': legendgroupdict[legend_group]['width'],
+                  'color': '#96c99f'},
+            marker={'size': 4},
+            **map_subplot(position)))
+    return traces
+
+
+def line_precision(trace):
+    # The left subplot shows costs, the right one emissions
+    return {'y': figure_precision['costs' if trace['yaxis'] == 'y' else 'emissions']}
+
+
+def country_precision(trace):
+    # The WebGL chart has numeric x positions, the bar chart has zone and scenario names
+    if trace['type'] == 'scattergl':
+        return {'x': 1, 'y': figure_precision['countries'], 'customdata': figure_precision['countries']}
+    return {'y': figure_precision['countries']}
+
+
+map_precision = {'lon': figure_precision['coordinates'], 'lat': figure_precision['coordinates']}
+
+
+def patch_bar_data(rows, bars, x_columns, precision):
+    # Patch drawing the bar traces of a figure for a new selection: only their x and y arrays are sent, compacted with
+    # the same precision as the full figure
+    patch = Patch()
+    with callback_metrics.phase('serialization'):
+        for i, data in enumerate(bar_data(rows, bars, x_columns)):
+            data = compact_trace(data, precision)
+            patch['data'][i]['x'] = [level.tolist() for level in data['x']]
+            patch['data'][i]['y'] = data['y']
+    return patch
+
+
+def patch_scenario_blocks(old, new, block_length, added_blocks, precision, block_attributes=None):
+    # Patch going from a figure drawn for the old selection to the new one: blocks of unticked scenarios are deleted
+    # (from the end, so the indexes of earlier traces stay valid), blocks of newly ticked scenarios are inserted, and
+    # kept blocks only have the properties that depend on their position (legend, subplot) updated. Inserted traces are
+    # compacted with the same precision as the full figure.
+    patch = Patch()
+    for position in reversed(range(len(old))):
+        if old[position] not in new:
+            for i in reversed(range(block_length)):
+                del patch['data'][position * block_length + i]
+    index = 0
+    for position, scenario in enumerate(new):
+        if scenario in added_blocks:
+            for trace in added_blocks[scenario]:
+                with callback_metrics.phase('serialization'):
+                    trace = trace.to_plotly_json()
+                    trace = compact_trace(trace, precision(trace) if callable(precision) else precision)
+                patch['data'].insert(index, trace)
+                index += 1
+            continue
+        if block_attributes is not None and old.index(scenario) != position:
+            before = block_attributes(old.index(scenario))
+            after = block_attributes(position)
+            for i in range(block_length):
+                for key, value in after[i].items():
+                    if before[i].get(key) != value:
+                        patch['data'][index + i][key] = value
+        index += block_length
+    return patch
+
+
 # Callbacks
+# Callback functions are defined first and registered with the app at the end of this section, depending on the
+# filtering mode
+
 # Callback to synchronize checklists across multiple tabs
-@app.callback(
-    Output("tab_2_checklist_sync", "value"),
-    Output("tab_3_checklist_sync", "value"),
-    Output("tab_4_checklist_sync", "value"),
-    Input("tab_2_checklist_sync", "value"),
-    Input("tab_3_checklist_sync", "value"),
-    Input("tab_4_checklist_sync", "value"),
-)
 def sync_checklists(selected2, selected3, selected4):
     ctx = callback_context
     input_id = ctx.triggered[0]["prop_id"].split(".")[0]
     if input_id == "tab_3_checklist_sync":
         selected2 = selected3
         selected4 = selected3
-    if input_id == "tab_4_checklist_sync":
+    elif input_id == "tab_4_checklist_sync":
         selected2 = selected4
         selected3 = selected4
     else:
@@ -178,61 +439,14 @@ def sync_checklists(selected2, selected3, selected4):
 
 
 # Callback to generate all of the plots in the 'Future New Capacity and Cost' tab
-@app.callback(
-    [Output('barplot1', 'figure'),
-     Output('barplot2', 'figure'),
-     Output('lineplots', 'figure')],
-    Input('tab_2_checklist_sync', 'value'))
+@figure_cache.memoize('generation', sources=figure_sources['generation'])
 def plot_generation(tab_2_checklist):
-    capacity_df_plot = capacity_df[capacity_df['scs'].isin(tab_2_checklist)]
-    generation_df_plot = generation_df[generation_df['scs'].isin(tab_2_checklist)]
-
-    # Add dummy columns for plotting combined plot
-    capacity_df_plot["dummy_existing"] = 0
-    capacity_df_plot["dummy_new"] = 0
-
-    generation_df_plot["dummy_existing"] = 0
-    generation_df_plot["dummy_new"] = 0
+    capacity_df_plot = data_store.capacity(tab_2_checklist)
+    generation_df_plot = data_store.generation(tab_2_checklist)
 
     ## New capacity
-    # Flip this order to flip the year vs scenario grouping
-    x1 = [list(capacity_df_plot.period),
-          list(capacity_df_plot.scs)]
-
-    # Existing gen capacity
-    fig1 = go.Figure(go.Bar(x=x1, y=list(capacity_df_plot.Coal), name='Coal existing', marker_color=coal_color,
-                            marker_pattern_shape="x", legendgroup='1', showlegend=False))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Gas), name='Gas existing', marker_color=gas_color,
-                          marker_pattern_shape="x", legendgroup='1', showlegend=False))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Hydro), name='Hydro existing', marker_color=hydro_color,
-                          marker_pattern_shape="x", legendgroup='1', showlegend=False))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Solar), name='Solar existing', marker_color=solar_color,
-                          marker_pattern_shape="x", legendgroup='1', showlegend=False))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Wind), name='Wind existing', marker_color=wind_color,
-                          marker_pattern_shape="x", legendgroup='1', showlegend=False))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Nuclear), name='Nuclear existing', marker_color=nuclear_color,
-                          marker_pattern_shape="x", legendgroup='1', showlegend=False))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Other), name='Other existing', marker_color=other_color,
-                          marker_pattern_shape="x", legendgroup='1', showlegend=False))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.PStorage), name='Pumped storage<br>existing',
-                          marker_color=pstorage_color, marker_pattern_shape="x", legendgroup='1', showlegend=False))
-
-    # New gen capacity
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Coal_new), name='Coal new', marker_color=coal_color))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Gas_new), name='Gas new', marker_color=gas_color))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Hydro_new), name='Hydro new', marker_color=hydro_color))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Solar_new), name='Solar new', marker_color=solar_color))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Wind_new), name='Wind new', marker_color=wind_color))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Other_new), name='Other new', marker_color=other_color))
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.Battery), name='Battery new', marker_color=battery_color))
-
-    # Adding dummy markers
-    fig1.add_trace(go.Bar(x=x1, y=list(capacity_df_plot.dummy_existing), name='Existing<br> capacity',
-                          marker_color='white', marker_pattern_shape="x", legendgroup='1', showlegend=True))
-
-    # Remove white lines separating elements of bars
-    fig1.update_traces(marker_line_width=0,
-                       selector=dict(type="bar"))
+    # Existing gen capacity, new gen capacity and the dummy marker
+    fig1 = go.Figure(bar_traces(capacity_df_plot, capacity_bars, ['period', 'scs']))
 
     fig1.update_layout(barmode="relative", font=dict(size=12),
                        width=1000, height=600, plot_bgcolor='white',  # showlegend=False)
@@ -246,28 +460,7 @@ def plot_generation(tab_2_checklist):
     fig1.update_xaxes(tickangle=270)
 
     ## Energy generation
-    # Flip this order to flip the year vs scenario grouping
-    x2 = [list(generation_df_plot.period),
-          list(generation_df_plot.scs)]
-
-    fig2 = go.Figure(
-        go.Bar(x=x2, y=list(generation_df_plot.Trans_loss), name='Transmission <br>loss', marker_color=trans_color))
-    fig2.add_trace(
-        go.Bar(x=x2, y=list(generation_df_plot.PStorage), name='Pumped <br>storage', marker_color=pstorage_color))
-    fig2.add_trace(go.Bar(x=x2, y=list(generation_df_plot.Battery), name='Battery', marker_color=battery_color))
-    fig2.add_trace(go.Bar(x=x2, y=list(generation_df_plot.Coal), name='Coal', marker_color=coal_color))
-    fig2.add_trace(go.Bar(x=x2, y=list(generation_df_plot.Gas), name='Gas', marker_color=gas_color))
-    fig2.add_trace(go.Bar(x=x2, y=list(generation_df_plot.Nuclear), name='Nuclear', marker_color=nuclear_color))
-    fig2.add_trace(go.Bar(x=x2, y=list(generation_df_plot.Hydro), name='Hydro', marker_color=hydro_color))
-    fig2.add_trace(go.Bar(x=x2, y=list(generation_df_plot.Solar), name='Solar', marker_color=solar_color))
-    fig2.add_trace(go.Bar(x=x2, y=list(generation_df_plot.Wind), name='Wind', marker_color=wind_color))
-    fig2.add_trace(go.Bar(x=x2, y=list(generation_df_plot.Other), name='Other', marker_color=other_color))
-    fig2.add_trace(
-        go.Bar(x=x2, y=list(generation_df_plot.Curtailment), name='Curtailment', marker_color=curtailment_color))
-
-    # Remove white lines separating elements of bars
-    fig2.update_traces(marker_line_width=0,
-                       selector=dict(type="bar"))
+    fig2 = go.Figure(bar_traces(generation_df_plot, generation_bars, ['period', 'scs']))
 
     fig2.update_layout(barmode="relative", yaxis_title="Electricity generation (TWh)", font=dict(size=12),
                        width=1000, height=500, plot_bgcolor='white',  # showlegend=False)
@@ -279,25 +472,13 @@ def plot_generation(tab_2_checklist):
     fig2.update_xaxes(tickangle=270)
 
     # Costs and Emissions Plots
-    line_style_dict = {'Static Costs': {'Color': '#e09f3e', 'Dash': 'solid', 'Legend Group': '0'},
-                       'Existing Tx': {'Color': '#90be6d', 'Dash': 'dash', 'Legend Group': '1'},
-                       'Planned Tx': {'Color': '#4d908e', 'Dash': 'dash', 'Legend Group': '2'},
-                       'Reference': {'Color': '#766A00', 'Dash': 'solid', 'Legend Group': '3'},
-                       'Coal Ret. 55y': {'Color': '#343a40', 'Dash': 'dashdot', 'Legend Group': '4'},
-                       'Coal Ret. 45y': {'Color': '#766A00', 'Dash': 'dashdot', 'Legend Group': '5'},
-                       'Clean 80%': {'Color': '#277da1', 'Dash': 'dot', 'Legend Group': '6'}}
+    costs_lineplot = data_store.costs(tab_2_checklist)
+    emissions_lineplot = data_store.emissions(tab_2_checklist)
 
     fig3 = make_subplots(rows=1, cols=2)
 
     for selected in tab_2_checklist:
-        fig3.add_trace(go.Scatter(x=costs_lineplot['period'], y=costs_lineplot[selected], name=selected,
-                                  legendgroup=line_style_dict[selected]['Legend Group'],
-                                  line=dict(color=line_style_dict[selected]['Color'],
-                                            dash=line_style_dict[selected]['Dash'])), row=1, col=1)
-        fig3.add_trace(go.Scatter(x=emissions_lineplot['period'], y=emissions_lineplot[selected], name=selected,
-                                  legendgroup=line_style_dict[selected]['Legend Group'], showlegend=False,
-                                  line=dict(color=line_style_dict[selected]['Color'],
-                                            dash=line_style_dict[selected]['Dash'])), row=1, col=2)
+        fig3.add_traces(line_block(costs_lineplot, emissions_lineplot, selected))
 
     fig3.update_xaxes(tickangle=270)
     fig3.update_yaxes(gridcolor='#f5f5f5')
@@ -305,28 +486,113 @@ def plot_generation(tab_2_checklist):
     fig3.update_yaxes(title_text="Costs (USD per MWh)", row=1, col=1)
     fig3.update_yaxes(title_text=r'GHG Emissions (MtCO$_{2}$)', row=1, col=2)
 
-    return fig1, fig2, fig3
+    with callback_metrics.phase('serialization'):
+        return (compact_figure(fig1, {'y': figure_precision['capacity']}),
+                compact_figure(fig2, {'y': figure_precision['generation']}),
+                compact_figure(fig3, line_precision))
+
+
+@functools.lru_cache(maxsize=32)
+def ranked_zones(rank_by, version):
+    # Load zones in decreasing order of their new capacity of one technology (or all of them), over every scenario,
+    # or in the order they first appear in the data when unranked.
+    # The ranking doesn't depend on the selection, so the zones on a page stay put when scenarios are toggled.
+    # It is kept per version of the data, so the new builds of every scenario are only read again after a reload.
+    new_builds = data_store.new_builds(checklist_options)
+    if rank_by == 'Unranked':
+        return [str(zone) for zone in pd.unique(new_builds['load_zone'].astype(str))]
+    columns = [column for column, style in country_bars] if rank_by == 'Total' else [rank_by]
+    totals = new_builds.groupby('load_zone', observed=True, sort=False)[columns].sum().sum(axis=1)
+    return [str(zone) for zone in totals.sort_values(ascending=False, kind='stable').index]
+
+
+def zone_ranking(rank_by):
+    return ranked_zones(rank_by, data_version('countries'))
+
+
+def country_page(rank_by, page_size, page):
+    # Zones on a page, the zones ranked below it, the number of pages and the page (kept within the page count)
+    ranking = zone_ranking(rank_by)
+    page_size = page_size or len(ranking)
+    page_count = max(-(-len(ranking) // page_size), 1)
+    page = min(max(page or 1, 1), page_count)
+    return (ranking[(page - 1) * page_size:page * page_size], ranking[page * page_size:], page_count, page)
+
+
+def country_categories(zones, other):
+    # Load zones on the x axis: the zones on the page, then the 'Other' bar if there are zones below the page
+    return zones + ['Other ({} zones)'.format(len(other))] if other else list(zones)
+
+
+def country_rows(rows, zones, other):
+    # New builds of the zones on the page in ranking order, followed by one row per scenario with the sum of the
+    # zones ranked below the page
+    columns = [column for column, style in country_bars]
+    rows = rows.assign(load_zone=rows['load_zone'].astype(str), Scenario=rows['Scenario'].astype(str))
+    page = rows[rows['load_zone'].isin(zones)]
+    page = page.iloc[np.argsort(page['load_zone'].map({zone: i for i, zone in enumerate(zones)}).to_numpy(),
+                                kind='stable')]
+    if not other:
+        return page
+    rollup = (rows[rows['load_zone'].isin(other)].groupby('Scenario', sort=False)[columns].sum().reset_index()
+              .assign(load_zone=country_categories(zones, other)[-1]))
+    return pd.concat([page, rollup], ignore_index=True)
+
+
+def use_webgl(categories, scenarios):
+    # The clientside filters only know the layout of the bar chart, so the client mode always draws bars
+    return filtering_mode == 'server' and categories * scenarios > webgl_bar_limit
+
+
+def country_segments(rows, selection, categories):
+    # The stacked bars drawn as thick vertical line segments of WebGL traces, one trace per bar type (the browser
+    # draws these on the GPU, whatever the number of zones). Every (zone, scenario) pair has its own x position, with
+    # a gap between zones. A NaN y after every segment keeps it apart from the next one, so the x positions stay whole
+    # numbers (sent as small integers), and segments of zero capacity are left out. The segments don't react to the
+    # mouse: the hover text comes from an invisible point on top of every bar, which has the zone and scenario of the
+    # bar (sent once) and its new capacity of each bar type.
+    group = len(selection) + 1
+    positions = (rows['load_zone'].map({zone: i for i, zone in enumerate(categories)}).to_numpy() * group +
+                 rows['Scenario'].map({scenario: i for i, scenario in enumerate(selection)}).to_numpy())
+    width = max(0.8 * 1300 / (len(categories) * group), 1)
+    capacities = rows[[column for column, style in country_bars]].fillna(0).to_numpy(dtype=float)
+    base = np.zeros(len(rows))
+    traces = []
+    for i, (column, style) in enumerate(country_bars):
+        values = capacities[:, i]
+        drawn = values != 0
+        traces.append(go.Scattergl(
+            x=np.repeat(positions[drawn], 3),
+            y=np.column_stack([base[drawn], (base + values)[drawn], np.full(drawn.sum(), np.nan)]).ravel(),
+            mode='lines', name=style['name'],
+            line={'color': style['marker_color'], 'width': width}, hoverinfo='skip'))
+        base = base + values
+    hover = ''.join('<br>{}: %{{customdata[{}]:.3f}} GW'.format(style['name'], i)
+                    for i, (column, style) in enumerate(country_bars))
+    traces.append(go.Scattergl(
+        x=positions, y=base, mode='markers', marker={'opacity': 0}, showlegend=False, name='',
+        text=(rows['load_zone'] + '<br>' + rows['Scenario']).to_numpy(), customdata=capacities,
+        hovertemplate='%{text}' + hover + '<extra></extra>'))
+    return traces, [i * group + (len(selection) - 1) / 2 for i in range(len(categories))]
 
 
 # Callback to generate the country bar plot in tab 3
-@app.callback(
-    Output('countries_barplot_combined', 'figure'),
-    Input('tab_2_checklist_sync', 'value'))
-def update_fig4(tab_2_checklist):
-    selected_scenario_data = df_nbuilt[df_nbuilt['Scenario'].isin(tab_2_checklist)]
-
-    # Create multi level index
-    x = [
-        list(selected_scenario_data.load_zone),
-        list(selected_scenario_data.Scenario)
-    ]
-    # Add values of each power type for each observation
-    fig4 = go.Figure(go.Bar(x=x, y=list(selected_scenario_data.Wind), name='Wind', marker_color=wind_color))
-    fig4.add_trace(go.Bar(x=x, y=list(selected_scenario_data.SolarPV), name='Solar', marker_color=solar_color))
-    fig4.add_trace(go.Bar(x=x, y=list(selected_scenario_data.Battery), name='Battery', marker_color=battery_color))
-    fig4.add_trace(go.Bar(x=x, y=list(selected_scenario_data.Coal), name='Coal', marker_color=coal_color))
-    fig4.add_trace(go.Bar(x=x, y=list(selected_scenario_data.Gas), name='Gas', marker_color=gas_color))
-    fig4.add_trace(go.Bar(x=x, y=list(selected_scenario_data.Hydro), name='Hydro', marker_color=hydro_color))
+@figure_cache.memoize('countries', sources=figure_sources['countries'])
+def update_countries_barplot(tab_2_checklist, rank_by=country_rank, page_size=country_page_size, page=1):
+    zones, other, page_count, page = country_page(rank_by, page_size, page)
+    categories = country_categories(zones, other)
+    selected_scenario_data = country_rows(data_store.new_builds(tab_2_checklist), zones, other)
+
+    fig4 = go.Figure()
+    if use_webgl(len(categories), len(tab_2_checklist)):
+        traces, ticks = country_segments(selected_scenario_data, tab_2_checklist, categories)
+        fig4.add_traces(traces)
+        fig4.update_xaxes(tickvals=ticks, ticktext=categories)
+        # Hovering anywhere over a bar shows its hover point
+        fig4.update_layout(hovermode='x')
+    else:
+        # Add values of each power type for each observation, with load zone and scenario as the multi level index
+        fig4.add_traces(bar_traces(selected_scenario_data, country_bars, ['load_zone', 'Scenario']))
 
     fig4.update_layout(barmode="stack", yaxis_title="New-built capacities (GW)", font=dict(size=11),
                        width=1300, height=800,
@@ -336,48 +602,54 @@ def update_fig4(tab_2_checklist):
                       gridwidth=0.2, gridcolor='lightgrey')
     fig4.update_xaxes(showline=True, linewidth=1, linecolor='black', mirror=True, tickangle=270)
 
-    return fig4
+    with callback_metrics.phase('serialization'):
+        return compact_figure(fig4, country_precision)
 
-# Callback to generate all of the transmission maps in tab 4
-@app.callback(
-    Output('transmission_maps', 'figure'),
-    Input('tab_4_checklist_sync', 'value'))
-def update_fig4(tab_4_checklist):
+
+def map_rows(count):
+    # Number of rows of two maps needed for a number of scenarios
+    return max(round((count / 2) + 0.1), 1)
+
+
+def map_grid(scenarios):
     # Generate a plot framework with the correct dimensions, and appropriate titles
-    maps = make_subplots(rows=round((len(tab_4_checklist) / 2) + 0.1), cols=2,
-                         subplot_titles=tab_4_checklist,
+    rows = map_rows(len(scenarios))
+    maps = make_subplots(rows=rows, cols=2,
+                         subplot_titles=scenarios,
                          vertical_spacing=0.02,
-                         specs=[[{"type": "mapbox"}, {"type": "mapbox"}]] * round((len(tab_4_checklist) / 2) + 0.1))
-
-    for scenario in tab_4_checklist:
-        for row in range(map_df.shape[0]):
-            # Generate the coordinate endpoints for plotting
-            lat = []
-            lon = []
-            lat.append(map_df.loc[row, 'y_start'])
-            lat.append(map_df.loc[row, 'y_end'])
-            lon.append(map_df.loc[row, 'x_start'])
-            lon.append(map_df.loc[row, 'x_end'])
-
-            legend_group = map_df.loc[row, scenario + '_legendgroup']
-            # Add lines to their corresponding subplots
-            maps.add_trace(go.Scattermapbox(
-                mode="markers+lines",
-                lon=lon,
-                lat=lat,
-                name=legendgroupdict[legend_group]['name'],
-                legendgroup=int(legend_group),
-                showlegend=False,
-                line={'width': legendgroupdict[legend_group]['width'],
-                      'color': '#96c99f'},
-                marker={'size': 4}),
-                row=tab_4_checklist.index(scenario) // 2 + 1,
-                col=tab_4_checklist.index(scenario) % 2 + 1)
+                         specs=[[{"type": "mapbox"}, {"type": "mapbox"}]] * rows)
+
+    # Finalize the formatting for all of the subplots
+    maps.update_mapboxes(
+        center=dict(lat=-17, lon=26),
+        zoom=3,
+        style='carto-positron')
+    maps.update_layout(
+        legend_title_text='Transmission (MW)',
+        margin={'l': 0, 't': 30, 'b': 0, 'r': 10},
+        width=950,
+        height=500 * rows)
+    return maps
+
+
+def line_segments(lines):
+    # Coordinates of many transmission lines as one path: start, end and a NaN gap for every line
+    lon = np.column_stack([lines['x_start'], lines['x_end'], np.full(len(lines), np.nan)]).ravel()
+    lat = np.column_stack([lines['y_start'], lines['y_end'], np.full(len(lines), np.nan)]).ravel()
+    return lon, lat
+
+
+# Callback to generate all of the transmission maps in tab 4
+@figure_cache.memoize('transmission_maps', sources=figure_sources['transmission_maps'])
+def update_fig4(tab_4_checklist):
+    maps = map_grid(tab_4_checklist)
+
+    lines = data_store.transmission(tab_4_checklist)
+    for position, scenario in enumerate(tab_4_checklist):
+        maps.add_traces(map_block(lines[lines['scenario'] == scenario], position))
 
     # Adding dummy markers
-    for i in range(6):
-        if i == 0:
-            continue
+    for i in transmission_bins.index[1:]:
         maps.add_trace(go.Scattermapbox(
             mode="lines",
             lon=[0, 0],
@@ -389,17 +661,209 @@ def update_fig4(tab_4_checklist):
                   'color': '#96c99f'}
         ))
 
-    # Finalize the formatting for all of the subplots
-    maps.update_mapboxes(
-        center=dict(lat=-17, lon=26),
-        zoom=3,
-        style='carto-positron')
-    maps.update_layout(
-        legend_title_text='Transmission (MW)',
-        margin={'l': 0, 't': 30, 'b': 0, 'r': 10},
-        width=950,
-        height=500 * round((len(tab_4_checklist) / 2) + 0.1))
-    return maps
+    with callback_metrics.phase('serialization'):
+        return compact_figure(maps, map_precision)
+
+
+# Callbacks to update the figures that are already displayed
+# The first render (or the first one after the data changed) sends the full figures. After that, only a patch with the
+# new x and y arrays of the bar traces, and the trace blocks of the scenarios that were ticked or unticked, is sent. The selection the displayed figures were drawn
+# for is kept in a dcc.Store next to them.
+# Figures are only drawn for the tab that is open. The figures of the other tabs keep the selection they were drawn
+# for, and are brought up to date (patched, or drawn for the first time) when their tab is opened.
+def rendered_selection(name, rendered):
+    # None if the displayed figures have to be drawn from scratch
+    if rendered is None or rendered['version'] != data_version(name):
+        return None
+    return rendered['selection']
+
+
+def update_generation(tab_2_checklist, active_tab, rendered):
+    if active_tab != 'generation':
+        raise PreventUpdate
+    tab_2_checklist = normalize_selection(tab_2_checklist)
+    state = {'selection': tab_2_checklist, 'version': data_version('generation')}
+    old = rendered_selection('generation', rendered)
+    if old is None:
+        return (*plot_generation(tab_2_checklist), state)
+    if old == tab_2_checklist:
+        raise PreventUpdate
+
+    added = [scenario for scenario in tab_2_checklist if scenario not in old]
+    line_blocks = {}
+    if added:
+        costs_lineplot = data_store.costs(added)
+        emissions_lineplot = data_store.emissions(added)
+        line_blocks = {scenario: line_block(costs_lineplot, emissions_lineplot, scenario) for scenario in added}
+
+    return (patch_bar_data(data_store.capacity(tab_2_checklist), capacity_bars, ['period', 'scs'],
+                           {'y': figure_precision['capacity']}),
+            patch_bar_data(data_store.generation(tab_2_checklist), generation_bars, ['period', 'scs'],
+                           {'y': figure_precision['generation']}),
+            patch_scenario_blocks(old, tab_2_checklist, 2, line_blocks, line_precision),
+            state)
+
+
+def update_countries(tab_2_checklist, active_tab, rank_by, page_size, page, rendered):
+    if active_tab != 'countries':
+        raise PreventUpdate
+    tab_2_checklist = normalize_selection(tab_2_checklist)
+    zones, other, page_count, page = country_page(rank_by, page_size, page)
+    view = [rank_by, page_size, page]
+    webgl = use_webgl(len(country_categories(zones, other)), len(tab_2_checklist))
+    state = {'selection': tab_2_checklist, 'version': data_version('countries'), 'view': view, 'webgl': webgl}
+    pager = {'display': 'block' if page_count > 1 else 'none'}
+    old = rendered_selection('countries', rendered)
+    # A new ranking or page, and the WebGL chart (one trace per bar type, not per scenario), are drawn from scratch
+    if old is None or webgl or rendered.get('webgl') or rendered.get('view') != view:
+        return update_countries_barplot(tab_2_checklist, rank_by, page_size, page), state, page_count, pager
+    if old == tab_2_checklist:
+        raise PreventUpdate
+
+    return (patch_bar_data(country_rows(data_store.new_builds(tab_2_checklist), zones, other), country_bars,
+                           ['load_zone', 'Scenario'], {'y': figure_precision['countries']}),
+            state, page_count, pager)
+
+
+def update_transmission_maps(tab_4_checklist, active_tab, rendered):
+    if active_tab != 'transmission_maps':
+        raise PreventUpdate
+    tab_4_checklist = normalize_selection(tab_4_checklist)
+    state = {'selection': tab_4_checklist, 'version': data_version('transmission_maps')}
+    old = rendered_selection('transmission_maps', rendered)
+    if old is None:
+        return update_fig4(tab_4_checklist), state
+    if old == tab_4_checklist:
+        raise PreventUpdate
+
+    added = [scenario for scenario in tab_4_checklist if scenario not in old]
+    blocks = {}
+    if added:
+        lines = data_store.transmission(added)
+        blocks = {scenario: map_block(lines[lines['scenario'] == scenario], tab_4_checklist.index(scenario))
+                  for scenario in added}
+    block_length = len(transmission_bins)
+    maps = patch_scenario_blocks(old, tab_4_checklist, block_length, blocks, map_precision,
+                                 lambda position: [map_subplot(position)] * block_length)
+
+    # The grid of subplots, their titles and the height of the figure follow the new selection
+    old_grid = map_grid(old).to_plotly_json()['layout']
+    grid = map_grid(tab_4_checklist).to_plotly_json()['layout']
+    for key in set(old_grid) | set(grid):
+        if key not in grid:
+            del maps['layout'][key]
+        elif old_grid.get(key) != grid[key]:
+            maps['layout'][key] = grid[key]
+    return maps, state
+
+
+# Hot reload of ModuleData
+# The csv files are checked every CETLAB_RELOAD_INTERVAL seconds (5 by default, 0 turns it off). When some of them
+# change, only the tables made from them are prepared again and swapped in, and only the cached figures made from
+# those tables are dropped (their version changed). The figures for the full selection are built again right away, so
+# the first visitors after an update don't have to wait for them.
+reload_interval = float(os.environ.get('CETLAB_RELOAD_INTERVAL', '5'))
+figure_builders = {'generation': plot_generation,
+                   'countries': update_countries_barplot,
+                   'transmission_maps': update_fig4}
+
+
+def warm_figures(frames):
+    for name, builder in figure_builders.items():
+        if set(figure_frames[name]) & set(frames):
+            builder(checklist_options)
+
+
+loaded_data.on_reload(warm_figures)
+
+
+# The watcher is started by the first request of every process, since threads don't survive the fork of a worker
+@app.server.before_request
+def watch_module_data():
+    loaded_data.watch(reload_interval)
+
+
+# Registering the callbacks
+if filtering_mode == 'client':
+    # Every figure for the full selection is sent along with the layout, together with the empty map grid for each
+    # number of selected scenarios. The functions in assets/clientside.js filter these in the browser. The layout is
+    # made again for every page load (from the figure cache), so it follows reloads of the data.
+    module_layout = app.layout
+
+    def client_layout():
+        return dbc.Container(module_layout.children + [dcc.Store(id='figure_store', data={
+            'options': checklist_options,
+            'generation': plot_generation(checklist_options),
+            'countries': update_countries_barplot(checklist_options),
+            'transmission_maps': update_fig4(checklist_options),
+            'map_grids': [map_grid(checklist_options[:n]).to_plotly_json()['layout']
+                          for n in range(len(checklist_options) + 1)]})])
+
+    app.layout = client_layout
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='scenarios', function_name='sync_checklists'),
+        Output("tab_2_checklist_sync", "value"),
+        Output("tab_3_checklist_sync", "value"),
+        Output("tab_4_checklist_sync", "value"),
+        Input("tab_2_checklist_sync", "value"),
+        Input("tab_3_checklist_sync", "value"),
+        Input("tab_4_checklist_sync", "value"))
+    app.clientside_callback(
+        ClientsideFunction(namespace='scenarios', function_name='filter_generation'),
+        [Output('barplot1', 'figure'),
+         Output('barplot2', 'figure'),
+         Output('lineplots', 'figure')],
+        Input('tab_2_checklist_sync', 'value'),
+        State('figure_store', 'data'))
+    app.clientside_callback(
+        ClientsideFunction(namespace='scenarios', function_name='filter_countries'),
+        Output('countries_barplot_combined', 'figure'),
+        Input('tab_2_checklist_sync', 'value'),
+        State('figure_store', 'data'))
+    app.clientside_callback(
+        ClientsideFunction(namespace='scenarios', function_name='filter_transmission_maps'),
+        Output('transmission_maps', 'figure'),
+        Input('tab_4_checklist_sync', 'value'),
+        State('figure_store', 'data'))
+else:
+    app.layout.children.extend([dcc.Store(id='generation_rendered'),
+                                dcc.Store(id='countries_rendered'),
+                                dcc.Store(id='transmission_maps_rendered')])
+
+    app.callback(
+        Output("tab_2_checklist_sync", "value"),
+        Output("tab_3_checklist_sync", "value"),
+        Output("tab_4_checklist_sync", "value"),
+        Input("tab_2_checklist_sync", "value"),
+        Input("tab_3_checklist_sync", "value"),
+        Input("tab_4_checklist_sync", "value"),
+    )(callback_metrics.instrument(sync_checklists))
+    app.callback(
+        [Output('barplot1', 'figure'),
+         Output('barplot2', 'figure'),
+         Output('lineplots', 'figure'),
+         Output('generation_rendered', 'data')],
+        Input('tab_2_checklist_sync', 'value'),
+        Input('tabs', 'value'),
+        State('generation_rendered', 'data'))(callback_metrics.instrument(update_generation))
+    app.callback(
+        Output('countries_barplot_combined', 'figure'),
+        Output('countries_rendered', 'data'),
+        Output('country_page', 'max_value'),
+        Output('country_pager', 'style'),
+        Input('tab_2_checklist_sync', 'value'),
+        Input('tabs', 'value'),
+        Input('country_rank', 'value'),
+        Input('country_page_size', 'value'),
+        Input('country_page', 'active_page'),
+        State('countries_rendered', 'data'))(callback_metrics.instrument(update_countries))
+    app.callback(
+        Output('transmission_maps', 'figure'),
+        Output('transmission_maps_rendered', 'data'),
+        Input('tab_4_checklist_sync', 'value'),
+        Input('tabs', 'value'),
+        State('transmission_maps_rendered', 'data'))(callback_metrics.instrument(update_transmission_maps))
 
 
 if __name__ == '__main__':
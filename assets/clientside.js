@@ -0,0 +1,110 @@
+// Clientside callbacks used when Dash.py runs with CETLAB_FILTERING=client
+// The figures for the full selection are stored in the 'figure_store' dcc.Store, and these functions filter them
+// down to the checked scenarios without going back to the server.
+
+// Typed array constructors of the dtypes that compact_figure in figure_payload.py sends
+var typedArrays = {i1: Int8Array, i2: Int16Array, i4: Int32Array, f4: Float32Array, f8: Float64Array};
+
+// Values of a data array, which may have been sent as a base64 typed array ({dtype, bdata})
+function arrayValues(values) {
+    if (!values || !values.bdata) {
+        return values;
+    }
+    var bytes = atob(values.bdata);
+    var buffer = new Uint8Array(bytes.length);
+    for (var i = 0; i < bytes.length; i++) {
+        buffer[i] = bytes.charCodeAt(i);
+    }
+    return Array.from(new typedArrays[values.dtype](buffer.buffer));
+}
+
+// Keep only the bars whose scenario (the second level of the x axis) is selected
+function filterBars(figure, selected) {
+    var data = figure.data.map(function (trace) {
+        var y = arrayValues(trace.y);
+        var keep = [];
+        trace.x[1].forEach(function (scenario, i) {
+            if (selected.has(scenario)) {
+                keep.push(i);
+            }
+        });
+        return Object.assign({}, trace, {
+            x: trace.x.map(function (level) {
+                return keep.map(function (i) { return level[i]; });
+            }),
+            y: keep.map(function (i) { return y[i]; })
+        });
+    });
+    return {data: data, layout: figure.layout};
+}
+
+// Keep only the line traces named after a selected scenario
+function filterLines(figure, selected) {
+    var data = figure.data.filter(function (trace) {
+        return selected.has(trace.name);
+    });
+    return {data: data, layout: figure.layout};
+}
+
+// Number of the mapbox subplot a trace belongs to ('mapbox' is 1, 'mapbox2' is 2, ...)
+function subplotNumber(trace) {
+    var subplot = trace.subplot || 'mapbox';
+    return subplot === 'mapbox' ? 1 : parseInt(subplot.slice('mapbox'.length), 10);
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    scenarios: {
+        // Same behaviour as sync_checklists in Dash.py
+        sync_checklists: function (selected2, selected3, selected4) {
+            var triggered = dash_clientside.callback_context.triggered;
+            var inputId = triggered.length ? triggered[0].prop_id.split('.')[0] : '';
+            if (inputId === 'tab_3_checklist_sync') {
+                return [selected3, selected3, selected3];
+            }
+            if (inputId === 'tab_4_checklist_sync') {
+                return [selected4, selected4, selected4];
+            }
+            return [selected2, selected2, selected2];
+        },
+
+        filter_generation: function (selection, store) {
+            var selected = new Set(selection);
+            return [
+                filterBars(store.generation[0], selected),
+                filterBars(store.generation[1], selected),
+                filterLines(store.generation[2], selected)
+            ];
+        },
+
+        filter_countries: function (selection, store) {
+            return filterBars(store.countries, new Set(selection));
+        },
+
+        // The stored figure has one subplot per scenario, in checklist order. Selected scenarios are moved to the
+        // subplot matching their position in the selection, and the layout is swapped for the grid of that size.
+        filter_transmission_maps: function (selection, store) {
+            var ordered = store.options.filter(function (option) {
+                return selection.indexOf(option) !== -1;
+            });
+            var data = [];
+            store.transmission_maps.data.forEach(function (trace) {
+                if (trace.showlegend) {
+                    // Dummy markers for the legend
+                    data.push(trace);
+                    return;
+                }
+                var position = ordered.indexOf(store.options[subplotNumber(trace) - 1]);
+                if (position !== -1) {
+                    data.push(Object.assign({}, trace, {
+                        subplot: position === 0 ? 'mapbox' : 'mapbox' + (position + 1)
+                    }));
+                }
+            });
+            var layout = JSON.parse(JSON.stringify(store.map_grids[ordered.length]));
+            (layout.annotations || []).forEach(function (annotation, i) {
+                annotation.text = ordered[i];
+            });
+            return {data: data, layout: layout};
+        }
+    }
+});
@@ -0,0 +1,258 @@
+# Benchmarks for the Dash.py callbacks
+# Imports the app and calls the figure callbacks and sync_checklists directly for every subset of the checklist
+# options, recording the wall time of each call (percentiles), the peak memory it allocates and the size of the JSON
+# sent to the browser. The figure cache is cleared before every call, so each call measures a full build.
+# With --scale N the ModuleData tables are replicated to N times the scenarios, load zones and transmission lines
+# (the subsets are then the subsets of the original options, each with all of their copies).
+# The results are written to a JSON report. Given a previous report with --baseline, the run fails (exit status 1)
+# if a callback got slower, used more memory or sent more data than the baseline by more than --threshold.
+#   python benchmark.py
+#   python benchmark.py --scale 10 --subsets 16 --output scale10.json
+#   python benchmark.py --baseline benchmark_report.json --output new_report.json
+import argparse
+import contextvars
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.io as pio
+from dash import __version__ as dash_version
+from dash._callback_context import context_value
+from dash._utils import AttributeDict
+
+import Dash
+import module_data
+from scenario_store import FrameStore, SQLiteStore, build_database
+
+report_format = 1
+
+# Statistics compared against the baseline (metric, statistic)
+compared_metrics = [('wall_ms', 'p50'), ('wall_ms', 'p95'), ('peak_memory_bytes', 'max'), ('payload_bytes', 'mean')]
+# Wall time changes smaller than this are timer noise, whatever their relative size
+min_wall_change_ms = 1.0
+
+
+def replica_name(name, copy):
+    # The first copy keeps the original name, the others are numbered: 'Reference', 'Reference #2', ...
+    return name if copy == 0 else '{} #{}'.format(name, copy + 1)
+
+
+def replicate_rows(frame, column, scale):
+    # Copies of every row, one per replica of the value in column
+    copies = [frame.assign(**{column: [replica_name(value, copy) for value in frame[column].astype(str)]})
+              for copy in range(scale)]
+    scaled = pd.concat(copies, ignore_index=True)
+    scaled[column] = scaled[column].astype('category')
+    return scaled
+
+
+def replicate_columns(frame, scenarios, scale, suffix=''):
+    # Copies of the columns of every scenario, placed next to the original ones
+    copies = {replica_name(scenario, copy) + suffix: frame[scenario + suffix]
+              for scenario in scenarios for copy in range(1, scale)}
+    return pd.concat([frame, pd.DataFrame(copies, index=frame.index)], axis=1)
+
+
+def scale_module_data(frames, scale):
+    # Tables with scale times the scenarios, load zones and transmission lines. Replicated lines are moved slightly,
+    # so they aren't drawn on top of each other.
+    scenarios = module_data.checklist_options
+    scaled = {'capacity_df': replicate_rows(frames['capacity_df'], 'scs', scale),
+              'generation_df': replicate_rows(frames['generation_df'], 'scs', scale),
+              'costs_lineplot': replicate_columns(frames['costs_lineplot'], scenarios, scale),
+              'emissions_lineplot': replicate_columns(frames['emissions_lineplot'], scenarios, scale),
+              'df_nbuilt': replicate_rows(replicate_rows(frames['df_nbuilt'], 'load_zone', scale), 'Scenario', scale)}
+
+    map_df = frames['map_df']
+    line_copies = []
+    for copy in range(scale):
+        lines = map_df.copy()
+        lines['ID'] = map_df['ID'] + copy * (map_df['ID'].max() + 1)
+        lines['transmission_line'] = [replica_name(line, copy) for line in map_df['transmission_line'].astype(str)]
+        for column in ['x_start', 'y_start', 'x_end', 'y_end']:
+            lines[column] = map_df[column] + 0.05 * copy
+        line_copies.append(lines)
+    map_df = pd.concat(line_copies, ignore_index=True)
+    map_df = replicate_columns(map_df, scenarios, scale)
+    scaled['map_df'] = replicate_columns(map_df, scenarios, scale, suffix='_legendgroup')
+    return scaled
+
+
+def scaled_options(scale):
+    return [replica_name(scenario, copy) for scenario in module_data.checklist_options for copy in range(scale)]
+
+
+def use_scaled_data(scale):
+    # Point the Dash.py callbacks at replicated tables, in the same kind of data store the app was started with
+    options = scaled_options(scale)
+    frames = scale_module_data(module_data.load_module_data(), scale)
+    if Dash.loaded_data.kind == 'sqlite':
+        path = os.path.join(module_data.cache_dir, 'benchmark_x{}.sqlite'.format(scale))
+        build_database(frames, path, options)
+        Dash.data_store = SQLiteStore(path, options)
+    else:
+        Dash.data_store = FrameStore(frames, options)
+    Dash.checklist_options = options
+    # The zone ranking is kept per version of the csv files, which the replicated tables don't change
+    Dash.ranked_zones.cache_clear()
+    for scenario in module_data.checklist_options:
+        for copy in range(1, scale):
+            Dash.line_style_dict[replica_name(scenario, copy)] = Dash.line_style_dict[scenario]
+
+
+def selections(scale, subsets, seed):
+    # Every subset of the checklist options (with all of their copies), or a random sample that always includes the
+    # full selection
+    options = module_data.checklist_options
+    combinations = [list(combination) for size in range(len(options) + 1)
+                    for combination in itertools.combinations(options, size)]
+    if subsets is not None and subsets < len(combinations):
+        combinations = random.Random(seed).sample(combinations[:-1], subsets - 1) + [combinations[-1]]
+    return [[replica_name(scenario, copy) for scenario in combination for copy in range(scale)]
+            for combination in combinations]
+
+
+def sync_checklists(selection):
+    # sync_checklists reads the triggering checklist from the callback context, which Dash only sets during a request
+    context_value.set(AttributeDict(triggered_inputs=[{'prop_id': 'tab_3_checklist_sync.value',
+                                                       'value': selection}]))
+    return Dash.sync_checklists(selection, selection, selection)
+
+
+benchmarked_callbacks = {'plot_generation': lambda selection: Dash.plot_generation(selection),
+                         'update_countries_barplot': lambda selection: Dash.update_countries_barplot(selection),
+                         'update_fig4': lambda selection: Dash.update_fig4(selection),
+                         'sync_checklists': sync_checklists}
+
+
+def measure(callback, selection, repeat):
+    # Wall times of repeat calls, then one more call under tracemalloc for the peak memory
+    times = []
+    for _ in range(repeat):
+        Dash.figure_cache.clear()
+        start = time.perf_counter()
+        result = callback(selection)
+        times.append((time.perf_counter() - start) * 1000)
+    Dash.figure_cache.clear()
+    tracemalloc.start()
+    callback(selection)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # Size of the JSON Dash sends for the result
+    payload = len(pio.json.to_json_plotly(result).encode())
+    return times, peak, payload
+
+
+def summarize(times, peaks, payloads):
+    times = np.array(times)
+    return {'calls': len(times),
+            'wall_ms': {'mean': times.mean(), 'p50': np.percentile(times, 50), 'p90': np.percentile(times, 90),
+                        'p95': np.percentile(times, 95), 'p99': np.percentile(times, 99), 'max': times.max()},
+            'peak_memory_bytes': {'mean': float(np.mean(peaks)), 'max': int(np.max(peaks))},
+            'payload_bytes': {'mean': float(np.mean(payloads)), 'max': int(np.max(payloads)),
+                              'total': int(np.sum(payloads))}}
+
+
+def run(callbacks, scale, subsets, repeat, seed):
+    runs = selections(scale, subsets, seed)
+    results = {}
+    for name in callbacks:
+        times, peaks, payloads, details = [], [], [], []
+        for selection in runs:
+            call_times, peak, payload = measure(benchmarked_callbacks[name], selection, repeat)
+            times.extend(call_times)
+            peaks.append(peak)
+            payloads.append(payload)
+            details.append({'scenarios': len(selection), 'selection': selection, 'wall_ms': np.median(call_times),
+                            'peak_memory_bytes': peak, 'payload_bytes': payload})
+        results[name] = dict(summarize(times, peaks, payloads), selections=details)
+        print('{}: p50 {:.2f} ms, p95 {:.2f} ms, peak memory {:.1f} MB, payload {:.1f} kB (mean of {} selections)'
+              .format(name, results[name]['wall_ms']['p50'], results[name]['wall_ms']['p95'],
+                      results[name]['peak_memory_bytes']['max'] / 1e6, results[name]['payload_bytes']['mean'] / 1e3,
+                      len(runs)))
+    return results
+
+
+def regressions(report, baseline, threshold):
+    # Metrics that are more than threshold (a fraction) above the baseline
+    found = []
+    for name, results in report['callbacks'].items():
+        if name not in baseline['callbacks']:
+            continue
+        for metric, statistic in compared_metrics:
+            before = baseline['callbacks'][name][metric][statistic]
+            after = results[metric][statistic]
+            if metric == 'wall_ms' and after - before < min_wall_change_ms:
+                continue
+            if before > 0 and after > before * (1 + threshold):
+                found.append({'callback': name, 'metric': '{}.{}'.format(metric, statistic), 'baseline': before,
+                              'current': after, 'change': after / before - 1})
+    return found
+
+
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got {}'.format(value))
+    return value
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Dash.py callbacks for every scenario selection')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='replicate the scenarios, load zones and transmission lines this many times')
+    parser.add_argument('--subsets', type=int, default=None,
+                        help='benchmark a random sample of this many selections instead of all of them')
+    parser.add_argument('--repeat', type=positive_int, default=5, help='timed calls per selection')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the selection sample')
+    parser.add_argument('--callbacks', nargs='+', choices=list(benchmarked_callbacks),
+                        default=list(benchmarked_callbacks))
+    parser.add_argument('--output', default='benchmark_report.json', help='path of the JSON report')
+    parser.add_argument('--baseline', help='previous report to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed increase over the baseline, as a fraction (0.2 is 20%%)')
+    arguments = parser.parse_args(arguments)
+
+    if arguments.scale > 1:
+        use_scaled_data(arguments.scale)
+    results = contextvars.copy_context().run(run, arguments.callbacks, arguments.scale, arguments.subsets,
+                                             arguments.repeat, arguments.seed)
+    report = {'format': report_format,
+              'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                              'dash': dash_version, 'plotly': plotly.__version__, 'pandas': pd.__version__,
+                              'data_store': Dash.loaded_data.kind},
+              'settings': {'scale': arguments.scale, 'subsets': arguments.subsets, 'repeat': arguments.repeat,
+                           'seed': arguments.seed, 'threshold': arguments.threshold},
+              'callbacks': results}
+
+    status = 0
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+        for setting in ['scale', 'subsets', 'seed']:
+            if baseline['settings'][setting] != report['settings'][setting]:
+                print('Warning: the baseline was run with --{} {}'.format(setting, baseline['settings'][setting]))
+        report['baseline'] = arguments.baseline
+        report['regressions'] = regressions(report, baseline, arguments.threshold)
+        for regression in report['regressions']:
+            print('Regression: {callback} {metric} went from {baseline:.2f} to {current:.2f} ({change:+.0%})'
+                  .format(**regression))
+        status = 1 if report['regressions'] else 0
+
+    with open(arguments.output, 'w') as file:
+        json.dump(report, file, indent=1, default=float)
+    print('Report written to {}'.format(arguments.output))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+# Per-callback timings for the Dash.py server
+# Every callback request is timed, and its time split into phases: reading the selected rows from the data store
+# ('data'), building the figures ('figure') and turning them into JSON ('serialization', which covers compacting the
+# figures and the encoding and request handling done by Dash after the callback returns). The phases of a request are
+# sent back in a Server-Timing header (shown in the browser's network tab), and aggregated into histograms per
+# callback that are rendered in the Prometheus text format for the /metrics endpoint.
+# With several worker processes, each one keeps its own histograms. WorkerStats collects snapshots of them (and of the
+# other counters of Dash.py) from every worker in a shared SQLite file, so an endpoint can report the totals of all
+# workers, whichever worker answers it.
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, in seconds and bytes
+duration_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+size_buckets = (1e3, 4e3, 16e3, 64e3, 256e3, 1e6, 4e6, float('inf'))
+
+phases = ('data', 'figure', 'serialization')
+
+
+def format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def server_timing(timings):
+    # Server-Timing header value, durations in milliseconds
+    return ', '.join('{};dur={:.2f}'.format(name, seconds * 1000) for name, seconds in timings.items())
+
+
+class Histogram:
+    # Cumulative histogram in the Prometheus layout: a count per bucket upper bound, plus the sum and the count
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+    def add(self, other):
+        # Add the counts of a histogram with the same buckets (as returned by to_dict)
+        self.counts = [count + added for count, added in zip(self.counts, other['counts'])]
+        self.sum += other['sum']
+        self.count += other['count']
+
+    def lines(self, name, labels):
+        for upper, count in zip(self.buckets, self.counts):
+            yield '{}_bucket{} {}'.format(name, format_labels(labels + [('le', format_number(upper))]), count)
+        yield '{}_sum{} {}'.format(name, format_labels(labels), format_number(self.sum))
+        yield '{}_count{} {}'.format(name, format_labels(labels), self.count)
+
+
+class TimedCalls:
+    # Wraps an object (the data store) so that every method call is counted in a phase of the current request
+    def __init__(self, target, phase, metrics):
+        self.target = target
+        self._phase = phase
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self.target, name)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def timed(*args, **kwargs):
+            with self._metrics.phase(self._phase):
+                return attribute(*args, **kwargs)
+        return timed
+
+
+class CallbackMetrics:
+    # Request timings are collected per thread (Dash runs a callback in the thread of its request) and added to the
+    # histograms once the response is ready
+    def __init__(self, prefix='cetlab'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._durations = {}
+        self._phases = {}
+        self._sizes = {}
+        self._requests = {}
+
+    def begin(self):
+        self._local.request = {'start': time.perf_counter(), 'callback': None, 'seconds': {}}
+
+    def _current(self):
+        return getattr(self._local, 'request', None)
+
+    @contextmanager
+    def phase(self, name):
+        # Adds the time spent in the block to a phase of the current request (nothing outside a callback request)
+        current = self._current()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if current is not None:
+                current['seconds'][name] = current['seconds'].get(name, 0.0) + time.perf_counter() - start
+
+    def timed(self, target, phase):
+        return TimedCalls(target, phase, self)
+
+    def instrument(self, function):
+        # Wrapper for a callback function, so its requests are recorded under its name
+        @functools.wraps(function)
+        def instrumented(*args, **kwargs):
+            current = self._current()
+            if current is not None:
+                current['callback'] = function.__name__
+            with self.phase('callback'):
+                return function(*args, **kwargs)
+        return instrumented
+
+    def end(self, status, size, fallback_name=None):
+        # Record the finished request and return its phase timings, or None if no request was started
+        current = self._current()
+        self._local.request = None
+        if current is None:
+            return None
+        total = time.perf_counter() - current['start']
+        seconds = current['seconds']
+        callback = seconds.get('callback', 0.0)
+        data = seconds.get('data', 0.0)
+        compacting = seconds.get('serialization', 0.0)
+        timings = {'data': data,
+                   'figure': max(callback - data - compacting, 0.0),
+                   'serialization': compacting + max(total - callback, 0.0),
+                   'total': total}
+        name = current['callback'] or fallback_name or 'unknown'
+        with self._lock:
+            self._durations.setdefault(name, Histogram(duration_buckets)).observe(total)
+            for phase in phases:
+                self._phases.setdefault((name, phase), Histogram(duration_buckets)).observe(timings[phase])
+            self._sizes.setdefault(name, Histogram(size_buckets)).observe(size)
+            self._requests[(name, status)] = self._requests.get((name, status), 0) + 1
+        return timings
+
+    def snapshot(self):
+        # Histograms and counters of this process, in a form that can be stored as JSON
+        with self._lock:
+            return {'durations': [[name, histogram.to_dict()] for name, histogram in self._durations.items()],
+                    'phases': [[name, phase, histogram.to_dict()] for (name, phase), histogram in self._phases.items()],
+                    'sizes': [[name, histogram.to_dict()] for name, histogram in self._sizes.items()],
+                    'requests': [[name, status, count] for (name, status), count in self._requests.items()]}
+
+    def render(self, others=()):
+        # All metrics in the Prometheus text exposition format: those of this process added to the snapshots of other
+        # worker processes
+        snapshots = [self.snapshot()] + list(others)
+        durations, phases, sizes, requests = {}, {}, {}, {}
+        for snapshot in snapshots:
+            for name, histogram in snapshot['durations']:
+                durations.setdefault(name, Histogram(duration_buckets)).add(histogram)
+            for name, phase, histogram in snapshot['phases']:
+                phases.setdefault((name, phase), Histogram(duration_buckets)).add(histogram)
+            for name, histogram in snapshot['sizes']:
+                sizes.setdefault(name, Histogram(size_buckets)).add(histogram)
+            for name, status, count in snapshot['requests']:
+                requests[(name, status)] = requests.get((name, status), 0) + count
+
+        prefix = self.prefix
+        lines = ['# HELP {}_callback_requests_total Callback requests by response status'.format(prefix),
+                 '# TYPE {}_callback_requests_total counter'.format(prefix)]
+        for (name, status), count in sorted(requests.items()):
+            lines.append('{}_callback_requests_total{} {}'.format(
+                prefix, format_labels([('callback', name), ('status', status)]), count))
+
+        lines += ['# HELP {}_callback_duration_seconds Time to answer a callback request'.format(prefix),
+                  '# TYPE {}_callback_duration_seconds histogram'.format(prefix)]
+        for name, histogram in sorted(durations.items()):
+            lines.extend(histogram.lines(prefix + '_callback_duration_seconds', [('callback', name)]))
+
+        lines += ['# HELP {}_callback_phase_seconds Time spent in each phase of a callback request'.format(prefix),
+                  '# TYPE {}_callback_phase_seconds histogram'.format(prefix)]
+        for (name, phase), histogram in sorted(phases.items()):
+            lines.extend(histogram.lines(prefix + '_callback_phase_seconds', [('callback', name), ('phase', phase)]))
+
+        lines += ['# HELP {}_callback_response_bytes Size of the callback responses'.format(prefix),
+                  '# TYPE {}_callback_response_bytes histogram'.format(prefix)]
+        for name, histogram in sorted(sizes.items()):
+            lines.extend(histogram.lines(prefix + '_callback_response_bytes', [('callback', name)]))
+
+        lines += ['# HELP {}_worker_processes Worker processes whose requests are counted'.format(prefix),
+                  '# TYPE {}_worker_processes gauge'.format(prefix),
+                  '{}_worker_processes {}'.format(prefix, len(snapshots))]
+        return '\n'.join(lines) + '\n'
+
+
+class WorkerStats:
+    # Snapshots of the counters of every worker process, in an SQLite file on local disk that they all share. Every
+    # worker writes its snapshot from a background thread, at most every interval seconds, so the snapshots of the
+    # other workers are up to that much behind. The rows of workers that stopped are kept, so the totals keep counting
+    # up until the file is cleared when the app is started again (wsgi.py).
+    def __init__(self, path, timeout=10.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._worker = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, pid INTEGER, '
+                               'updated REAL, snapshot TEXT)')
+
+    def _connection(self):
+        # One connection per thread and process, as in SharedFigureStore
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def publish(self, worker, snapshot):
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?)',
+                               (worker, os.getpid(), time.time(), json.dumps(snapshot)))
+
+    def others(self, part):
+        # One part of the snapshots of every worker except this one
+        rows = self._connection().execute('SELECT worker, snapshot FROM workers').fetchall()
+        return [json.loads(snapshot)[part] for worker, snapshot in rows if worker != self._worker]
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM workers')
+
+    def start(self, interval, collect):
+        # Write the snapshot returned by collect every interval seconds (when it changed) from a background thread.
+        # Threads don't survive a fork, so this is called again in every worker process. A worker is named by its
+        # process id and start time, so a new worker that gets the id of a stopped one doesn't replace its counters.
+        if self._worker is not None and self._worker.split('-')[0] == str(os.getpid()):
+            return
+        self._worker = '{}-{}'.format(os.getpid(), time.time())
+        worker = self._worker
+
+        def run():
+            published = None
+            while True:
+                time.sleep(interval)
+                try:
+                    snapshot = json.dumps(collect(), sort_keys=True)
+                    if snapshot != published:
+                        self.publish(worker, json.loads(snapshot))
+                        published = snapshot
+                except Exception:
+                    traceback.print_exc()
+
+        threading.Thread(target=run, name='worker-stats', daemon=True).start()
@@ -0,0 +1,200 @@
+# Static export of the Dash.py figures
+# The checklists only have 2^7 possible selections, so every figure the module can show can be drawn ahead of time.
+# This script draws the figures of plot_generation, the country chart and the transmission maps for every selection
+# on a pool of worker processes, and writes them as gzipped JSON files next to a static page (index.html) that loads
+# the figures of the ticked scenarios. The export folder can be served by any static file server, without Python:
+#   python export.py --output static_export
+#   python -m http.server --directory static_export
+# The live Dash server is still the place to author and check the figures before exporting them.
+import argparse
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import string
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import plotly
+import plotly.io as pio
+from dash import dcc, html
+
+import Dash
+from module_data import checklist_options, frame_sources, source_files
+
+page_template = string.Template('''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>$title</title>
+<script src="plotly.min.js"></script>
+<style>
+    body { font-family: sans-serif; margin: 2em auto; max-width: 1400px; }
+    .tabs button { padding: 0.6em 1.2em; border: 1px solid #ccc; background: #f8f8f8; cursor: pointer; }
+    .tabs button.active { background: white; border-bottom-color: white; font-weight: bold; }
+    .checklist { text-align: center; margin: 1.5em 0; }
+    .checklist label { margin-left: 20px; }
+    .tab { display: none; }
+    .tab.active { display: block; }
+    .graph { display: flex; justify-content: center; }
+</style>
+</head>
+<body>
+<div class="tabs" id="tabs"></div>
+<div class="checklist" id="checklist"></div>
+<div class="tab" id="overview"></div>
+<div class="tab" id="generation">
+    <div class="graph" id="barplot1"></div>
+    <div class="graph" id="barplot2"></div>
+    <div class="graph" id="lineplots"></div>
+</div>
+<div class="tab" id="countries"><div class="graph" id="countries_barplot_combined"></div></div>
+<div class="tab" id="transmission_maps"><div class="graph" id="transmission_maps_graph"></div></div>
+<script>
+// Written by export.py. Every selection of scenarios has a file in figures/, named after the bits of the ticked
+// options in hexadecimal, with the figures of every tab. Only the figures of the open tab are drawn.
+var site = $site;
+var graphs = {generation: ['barplot1', 'barplot2', 'lineplots'],
+              countries: ['countries_barplot_combined'],
+              transmission_maps: ['transmission_maps_graph']};
+var loaded = {};
+var openTab = site.tabs[0].value;
+
+function selectionFile() {
+    var mask = 0;
+    site.options.forEach(function (option, i) {
+        if (document.getElementById('option' + i).checked) {
+            mask += Math.pow(2, i);
+        }
+    });
+    return 'figures/' + mask.toString(16).padStart(site.digits, '0') + '.json.gz';
+}
+
+function load(file) {
+    // Files are gzipped JSON, unpacked in the browser so any static server works (no Content-Encoding needed)
+    if (!loaded[file]) {
+        loaded[file] = fetch(file).then(function (response) {
+            return new Response(response.body.pipeThrough(new DecompressionStream('gzip'))).json();
+        });
+    }
+    return loaded[file];
+}
+
+function draw() {
+    if (!graphs[openTab]) {
+        return;
+    }
+    load(selectionFile()).then(function (figures) {
+        var tabFigures = [].concat(openTab === 'generation' ? figures.generation : [figures[openTab]]);
+        graphs[openTab].forEach(function (id, i) {
+            Plotly.react(id, tabFigures[i].data, tabFigures[i].layout);
+        });
+    });
+}
+
+site.tabs.forEach(function (tab) {
+    var button = document.createElement('button');
+    button.textContent = tab.label;
+    button.onclick = function () {
+        openTab = tab.value;
+        document.querySelectorAll('.tabs button').forEach(function (other) {
+            other.classList.toggle('active', other === button);
+        });
+        document.querySelectorAll('.tab').forEach(function (div) {
+            div.classList.toggle('active', div.id === tab.value);
+        });
+        document.getElementById('checklist').style.display = graphs[tab.value] ? 'block' : 'none';
+        draw();
+    };
+    document.getElementById('tabs').appendChild(button);
+});
+site.overview.forEach(function (text) {
+    var paragraph = document.createElement('p');
+    paragraph.textContent = text;
+    document.getElementById('overview').appendChild(paragraph);
+});
+site.options.forEach(function (option, i) {
+    var label = document.createElement('label');
+    label.innerHTML = '<input type="checkbox" checked id="option' + i + '"> ';
+    label.appendChild(document.createTextNode(option));
+    label.firstChild.onchange = draw;
+    document.getElementById('checklist').appendChild(label);
+});
+document.querySelector('.tabs button').click();
+</script>
+</body>
+</html>
+''')
+
+
+def selection_mask(selection):
+    return sum(1 << i for i, option in enumerate(checklist_options) if option in selection)
+
+
+def selection_file(selection):
+    digits = -(-len(checklist_options) // 4)
+    return '{:0{}x}.json.gz'.format(selection_mask(selection), digits)
+
+
+def all_selections():
+    return [[option for option in checklist_options if option in combination]
+            for size in range(len(checklist_options) + 1)
+            for combination in itertools.combinations(checklist_options, size)]
+
+
+def export_selection(selection, folder):
+    # Draw the figures of one selection and write them to their file. Runs in a worker process.
+    figures = {'generation': Dash.plot_generation(selection),
+               'countries': Dash.update_countries_barplot(selection),
+               'transmission_maps': Dash.update_fig4(selection)}
+    path = os.path.join(folder, 'figures', selection_file(selection))
+    # mtime=0 keeps the files the same from one export of the same data to the next
+    with open(path + '.tmp', 'wb') as file, gzip.GzipFile(fileobj=file, mode='wb', compresslevel=9, mtime=0) as gz:
+        gz.write(pio.json.to_json_plotly(figures).encode())
+    os.replace(path + '.tmp', path)
+    return selection_file(selection), os.path.getsize(path)
+
+
+def layout_text():
+    # Tab labels and overview paragraphs, taken from the Dash layout so the static page says the same
+    layout = Dash.app.layout() if callable(Dash.app.layout) else Dash.app.layout
+    tabs = next(child for child in layout.children if isinstance(child, dcc.Tabs))
+    overview = tabs.children[0].children[0].children
+    return ([{'label': tab.label, 'value': tab.value} for tab in tabs.children],
+            [' '.join(paragraph.children.split()) for paragraph in overview if isinstance(paragraph, html.P)])
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Export every figure of Dash.py as a static site')
+    parser.add_argument('--output', default='static_export', help='folder the site is written to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    arguments = parser.parse_args(arguments)
+
+    folder = arguments.output
+    os.makedirs(os.path.join(folder, 'figures'), exist_ok=True)
+    start = time.perf_counter()
+    selections = all_selections()
+    with ProcessPoolExecutor(max_workers=arguments.workers) as executor:
+        files = dict(executor.map(export_selection, selections, [folder] * len(selections)))
+
+    tabs, overview = layout_text()
+    site = {'options': checklist_options, 'digits': -(-len(checklist_options) // 4), 'tabs': tabs,
+            'overview': overview}
+    with open(os.path.join(folder, 'index.html'), 'w') as file:
+        file.write(page_template.substitute(title='CETLab', site=json.dumps(site)))
+    shutil.copy(os.path.join(os.path.dirname(plotly.__file__), 'package_data', 'plotly.min.js'), folder)
+
+    # What was exported, from which data
+    version = Dash.loaded_data.version(source_files(*frame_sources))
+    with open(os.path.join(folder, 'manifest.json'), 'w') as file:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'data_version': hashlib.sha1(repr(version).encode()).hexdigest(),
+                   'plotly': plotly.__version__, 'options': checklist_options, 'files': files}, file, indent=1)
+    print('Exported {} selections ({:.1f} MB) to {} in {:.1f} s'.format(
+        len(files), sum(files.values()) / 1e6, folder, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
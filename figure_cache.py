@@ -0,0 +1,231 @@
+# Figure cache for the Dash.py callbacks
+# The checklists only have a handful of options, so every callback sees a small, finite set of selections.
+# Figures are stored already serialized (plain dicts instead of plotly Figure objects), so a repeat selection
+# costs a dictionary lookup instead of rebuilding every trace.
+# When the app runs in several worker processes, the cache can also be backed by a SharedFigureStore, an SQLite file
+# on local disk that every worker reads and writes, so a figure built by one worker is reused by the others.
+import functools
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import plotly.graph_objects as go
+
+_missing = object()
+
+
+def file_stamps(paths):
+    # Modification time and size of each source file, used to invalidate entries when the inputs change
+    stamps = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps.append((path, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            stamps.append((path, None, None))
+    return tuple(stamps)
+
+
+def serialize(result):
+    # Convert plotly figures (or tuples of them) into the plain dicts Dash sends to the browser
+    if isinstance(result, go.Figure):
+        return result.to_plotly_json()
+    if isinstance(result, (tuple, list)):
+        return tuple(serialize(item) for item in result)
+    return result
+
+
+class SharedFigureStore:
+    # Cache entries in an SQLite file shared by every process on the machine. Values are pickled, and each row keeps
+    # the version of the files its figure was built from, so workers drop the rows of a callback whose files changed.
+    # The least recently used rows are removed beyond maxsize.
+    def __init__(self, path, maxsize=2048, timeout=10.0):
+        self.path = path
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS figures (key TEXT PRIMARY KEY, name TEXT, version TEXT, '
+                               'stored REAL, accessed REAL, value BLOB)')
+
+    def _connection(self):
+        # One connection per thread and process: connections opened before a worker was forked are not reused in it
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, name, key, version, ttl=None):
+        # The stored value, or _missing. Rows built from other versions of the files are deleted.
+        with self._connection() as connection:
+            row = connection.execute('SELECT version, stored, value FROM figures WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return _missing
+            if row[0] != version:
+                connection.execute('DELETE FROM figures WHERE name = ? AND version != ?', (name, version))
+                return _missing
+            if ttl is not None and time.time() - row[1] > ttl:
+                connection.execute('DELETE FROM figures WHERE key = ?', (key,))
+                return _missing
+            connection.execute('UPDATE figures SET accessed = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(row[2])
+
+    def set(self, name, key, version, value):
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO figures VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, name, version, now, now, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+            connection.execute('DELETE FROM figures WHERE key IN '
+                               '(SELECT key FROM figures ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM figures')
+
+    def size(self):
+        return self._connection().execute('SELECT COUNT(*) FROM figures').fetchone()[0]
+
+
+class FigureCache:
+    # Bounded LRU cache with optional time-to-live. Each entry belongs to a named callback, and each name
+    # remembers the version of the files it was built from, so a changed input only drops that callback's entries.
+    # With a shared store, entries missing from this process are looked up there before being rebuilt.
+    def __init__(self, maxsize=512, ttl=None, normalize=None, version=file_stamps, shared=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.normalize = normalize if normalize is not None else list
+        self.version = version
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'shared_hits': 0, 'evictions': 0, 'expirations': 0,
+                          'invalidations': 0}
+        self._by_name = {}
+
+    def _count(self, name, counter):
+        self._counters[counter] += 1
+        counts = self._by_name.setdefault(name, {'hits': 0, 'misses': 0})
+        if counter in counts:
+            counts[counter] += 1
+
+    def _check_version(self, name, version):
+        # Drop every entry of this callback if its source files changed since the entries were stored
+        if self._versions.get(name, version) != version:
+            stale = [key for key in self._entries if key[0] == name]
+            for key in stale:
+                del self._entries[key]
+            self._counters['invalidations'] += len(stale)
+        self._versions[name] = version
+
+    def get(self, key, version):
+        name = key[0]
+        with self._lock:
+            self._check_version(name, version)
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                self._counters['expirations'] += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._count(name, 'hits')
+                return entry[1]
+            if self.shared is None:
+                self._count(name, 'misses')
+                return _missing
+        # The shared store is read outside the lock, so other threads aren't held up by the disk
+        value = self.shared.get(name, repr(key), repr(version), self.ttl)
+        with self._lock:
+            if value is _missing:
+                self._count(name, 'misses')
+                return _missing
+            self._store(key, value)
+            self._count(name, 'hits')
+            self._counters['shared_hits'] += 1
+            return value
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self._counters['evictions'] += 1
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._check_version(key[0], version)
+            self._store(key, value)
+        if self.shared is not None:
+            self.shared.set(key[0], repr(key), repr(version), value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def snapshot(self):
+        # Counters of this process, in a form that can be stored as JSON
+        with self._lock:
+            return {'counters': dict(self._counters), 'size': len(self._entries),
+                    'callbacks': {name: dict(counts) for name, counts in self._by_name.items()}}
+
+    def stats(self, others=()):
+        # The counters of this process added to the snapshots of other worker processes. The size is the number of
+        # figures held in the local caches of all of them, the shared store is counted as a whole.
+        merged = self.snapshot()
+        for snapshot in others:
+            for counter, count in snapshot['counters'].items():
+                merged['counters'][counter] = merged['counters'].get(counter, 0) + count
+            merged['size'] += snapshot['size']
+            for name, counts in snapshot['callbacks'].items():
+                total = merged['callbacks'].setdefault(name, {'hits': 0, 'misses': 0})
+                for counter, count in counts.items():
+                    total[counter] = total.get(counter, 0) + count
+        stats = merged['counters']
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        stats['size'] = merged['size']
+        stats['maxsize'] = self.maxsize
+        stats['ttl'] = self.ttl
+        stats['callbacks'] = merged['callbacks']
+        stats['workers'] = 1 + len(others)
+        stats['pid'] = os.getpid()
+        if self.shared is not None:
+            stats['shared'] = {'path': self.shared.path, 'size': self.shared.size(), 'maxsize': self.shared.maxsize}
+        return stats
+
+    def memoize(self, name, sources=()):
+        # Decorator for callbacks whose first argument is the checklist selection. The selection is
+        # normalized (order and duplicates) before it is used as a key and before it reaches the callback,
+        # and any further arguments are added to the key as they are.
+        sources = tuple(sources)
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(selection, *args):
+                selection = self.normalize(selection)
+                key = (name, tuple(selection)) + args
+                version = self.version(sources)
+                result = self.get(key, version)
+                if result is _missing:
+                    result = serialize(func(selection, *args))
+                    # A figure built while the data was swapped may mix old and new data, so it isn't kept
+                    if self.version(sources) == version:
+                        self.set(key, version, result)
+                return result
+
+            wrapper.cache = self
+            return wrapper
+
+        return decorator
@@ -0,0 +1,63 @@
+# Compact figure payloads for the Dash.py callbacks
+# Figures are sent to the browser as JSON. Numeric arrays are rounded to the precision that is worth showing (which
+# also turns float noise like 6.46e-15 into 0), and longer arrays are sent as base64 typed arrays
+# ({'dtype': 'f4', 'bdata': ...}), which plotly.js (2.28 and up) decodes directly instead of parsing a list of numbers.
+# Two dimensional arrays (customdata with several values per point) are sent with their shape ('rows,columns').
+import base64
+
+import numpy as np
+
+# Arrays shorter than this stay plain JSON lists, where the base64 header would cost more than it saves
+typed_array_min_length = 32
+
+
+def round_array(values, digits):
+    # Round to a number of decimals, adding 0.0 so rounded negative noise doesn't come out as -0.0
+    return np.round(np.asarray(values, dtype=float), digits) + 0.0
+
+
+def typed_array(values, digits):
+    # Smallest typed array that keeps every value to the given number of decimals
+    finite = values[np.isfinite(values)]
+    spec = None
+    if finite.size == values.size and np.array_equal(finite, np.round(finite)):
+        for dtype, code in (('<i1', 'i1'), ('<i2', 'i2'), ('<i4', 'i4')):
+            info = np.iinfo(dtype)
+            if finite.size == 0 or (finite.min() >= info.min and finite.max() <= info.max):
+                spec = {'dtype': code, 'bdata': base64.b64encode(values.astype(dtype).tobytes()).decode('ascii')}
+                break
+    if spec is None:
+        single = values.astype('<f4')
+        if np.all(np.abs(single[np.isfinite(values)] - finite) <= 0.5 * 10.0 ** -digits):
+            spec = {'dtype': 'f4', 'bdata': base64.b64encode(single.tobytes()).decode('ascii')}
+        else:
+            spec = {'dtype': 'f8', 'bdata': base64.b64encode(values.astype('<f8').tobytes()).decode('ascii')}
+    if values.ndim > 1:
+        spec['shape'] = ','.join(str(length) for length in values.shape)
+    return spec
+
+
+def encode_array(values, digits):
+    values = round_array(values, digits)
+    if values.size < typed_array_min_length:
+        return values
+    return typed_array(values, digits)
+
+
+def compact_trace(trace, precision):
+    # precision maps trace attributes ('y', 'lon', ...) to the number of decimals kept
+    trace = dict(trace)
+    for attribute, digits in precision.items():
+        if attribute in trace and trace[attribute] is not None:
+            trace[attribute] = encode_array(trace[attribute], digits)
+    return trace
+
+
+def compact_figure(figure, precision):
+    # Serialized figure with compact data arrays. precision is a dict for every trace, or a function returning the
+    # dict of a trace (for figures with different metrics in different subplots).
+    figure = figure.to_plotly_json()
+    figure['data'] = [compact_trace(trace, precision(trace) if callable(precision) else precision)
+                      for trace in figure['data']]
+    return figure
+
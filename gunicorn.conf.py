@@ -0,0 +1,13 @@
+# gunicorn settings for the production entry point in wsgi.py
+#   gunicorn --config gunicorn.conf.py 'wsgi:create_app()'
+# The address and number of workers can be changed with the CETLAB_BIND and CETLAB_WORKERS environment variables.
+import multiprocessing
+import os
+
+bind = os.environ.get('CETLAB_BIND', '0.0.0.0:8050')
+# One worker per core: the callbacks are CPU bound, so more workers than cores only adds memory
+workers = int(os.environ.get('CETLAB_WORKERS', multiprocessing.cpu_count()))
+# Load the app (and the ModuleData tables) once in the main process, before the workers are forked
+preload_app = True
+# The first render of the transmission maps for a large selection can take a few seconds
+timeout = 60
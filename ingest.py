@@ -0,0 +1,253 @@
+# Ingestion of raw model results into the ModuleData tables
+# The csv files in ModuleData are summaries of the capacity expansion model's results: yearly generation and installed
+# capacity per period, new builds per load zone, costs, emissions and transmission capacities. This script makes them
+# from the raw results, one folder per scenario, named like the checklist option it is shown as:
+#   raw/transmission_lines.csv                 ID, transmission_line, x_start, y_start, x_end, y_end, one row per line
+#   raw/<scenario>/dispatch.csv                period, timepoint, load_zone, technology, dispatch_mw, timepoint_hours
+#   raw/<scenario>/capacity.csv                period, load_zone, technology, existing_mw, new_mw
+#   raw/<scenario>/summary.csv                 period, cost_per_mwh, emissions_mtco2
+#   raw/<scenario>/transmission.csv            period, transmission_line, capacity_mw
+# The technologies are the ones of electricity_generation.csv (Coal_IGCC, Gas_CCGT, SolarPV, curt_vre, ...). Other
+# columns of transmission_lines.csv (load zones, Planned, Status, ...) are copied to transmission_map_data.csv as they
+# are, except Existing: Dash.py draws the Existing Tx maps from that column, so it is set to the line capacities of the
+# Existing Tx scenario. Every checklist option of Dash.py needs a scenario folder.
+# dispatch.csv has a row per load zone, timepoint and technology, so it is by far the largest file. It is read in
+# chunks of --chunk-rows rows, and every chunk is summed into running totals per period and technology, so the memory
+# used depends on the chunk size and not on the size of the file. The scenarios are ingested in parallel, one per
+# worker process, and the tables are written once all of them are done:
+#   python ingest.py raw --output ModuleData
+# The tables are first written to a temporary folder and prepared from there the way Dash.py loads them. They only
+# replace the csv files in the output folder if the prepared tables have the ingested values, each in a single step,
+# so a running Dash.py reloads the new tables without seeing a half written one.
+import argparse
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from module_data import checklist_options, load_module_data, module_data_dir
+from scenario_store import FrameStore, line_columns
+
+# Technology columns of electricity_generation.csv, then the columns that are sums of them
+generation_technologies = ['Battery', 'Bioenergy', 'Coal_IGCC', 'Coal_Sub', 'Coal_Sup', 'Diesel', 'Gas_CCGT',
+                           'Gas_ICE', 'Gas_OCGT', 'Geothermal', 'Hydro', 'Nuclear', 'Oil', 'PStorage', 'SolarCSP',
+                           'SolarPV', 'Trans_loss', 'Wind', 'curt_hydro', 'curt_vre']
+generation_rollups = {'Coal': ['Coal_IGCC', 'Coal_Sub', 'Coal_Sup'],
+                      'Gas': ['Gas_CCGT', 'Gas_ICE', 'Gas_OCGT'],
+                      'Other': ['Bioenergy', 'Diesel', 'Oil', 'Geothermal'],
+                      'Solar': ['SolarCSP', 'SolarPV'],
+                      'Curtailment': ['curt_hydro', 'curt_vre']}
+
+# Technology groups of existing_and_new_capacity.csv. The groups in capacity_existing have a column of existing
+# capacity and a <group>_new column of new capacity, the groups in capacity_total a single column with all of it.
+capacity_groups = {'Battery': ['Battery'],
+                   'Coal': generation_rollups['Coal'],
+                   'Gas': generation_rollups['Gas'],
+                   'Hydro': ['Hydro'],
+                   'Nuclear': ['Nuclear'],
+                   'Other': generation_rollups['Other'],
+                   'PStorage': ['PStorage'],
+                   'Solar': generation_rollups['Solar'],
+                   'Wind': ['Wind']}
+capacity_existing = ['Coal', 'Gas', 'Hydro', 'Other', 'Solar', 'Wind']
+capacity_total = ['Battery', 'Nuclear', 'PStorage']
+capacity_columns = ['period', 'Battery', 'Coal', 'Coal_new', 'Gas', 'Gas_new', 'Hydro', 'Hydro_new', 'Nuclear',
+                    'Other', 'Other_new', 'PStorage', 'Solar', 'Solar_new', 'Wind', 'Wind_new', 'scs',
+                    'dummy_existing', 'dummy_new']
+
+# New builds per load zone in each of the df_nbuilt files, by column and the technologies it sums
+nbuilt_files = {'df_nbuilt_hydro.csv': {'Hydro': ['Hydro']},
+                'df_nbuilt_vre.csv': {'Wind': ['Wind'], 'SolarPV': ['SolarPV'], 'SolarCSP': ['SolarCSP'],
+                                      'Battery': ['Battery']},
+                'df_nbuilt_fossil.csv': {'Coal': generation_rollups['Coal'], 'Gas': generation_rollups['Gas']}}
+
+
+def read_chunks(path, columns, chunk_rows):
+    # A raw csv file in chunks of chunk_rows rows, with only the given columns and compact dtypes
+    dtypes = {column: 'category' for column in ['load_zone', 'technology', 'transmission_line'] if column in columns}
+    return pd.read_csv(path, usecols=columns, dtype=dtypes, chunksize=chunk_rows)
+
+
+def add_totals(totals, chunk_totals):
+    # Running totals: the sums of a chunk are added to the sums of the chunks before it
+    return chunk_totals if totals is None else totals.add(chunk_totals, fill_value=0)
+
+
+def generation_table(path, scenario, chunk_rows):
+    # Yearly generation per period (TWh) from the dispatch of every load zone and timepoint
+    totals = None
+    for chunk in read_chunks(path, ['period', 'technology', 'dispatch_mw', 'timepoint_hours'], chunk_rows):
+        energy = (chunk['dispatch_mw'] * chunk['timepoint_hours']).groupby(
+            [chunk['period'], chunk['technology']], observed=True).sum()
+        totals = add_totals(totals, energy)
+    table = (totals / 1e6).unstack('technology').reindex(columns=generation_technologies).fillna(0)
+    for column, technologies in generation_rollups.items():
+        table[column] = table[technologies].sum(axis=1)
+    table['scs'] = scenario
+    return table.sort_index().reset_index()
+
+
+def capacity_totals(path, chunk_rows):
+    # Existing and new capacity per period, load zone and technology (MW)
+    totals = None
+    for chunk in read_chunks(path, ['period', 'load_zone', 'technology', 'existing_mw', 'new_mw'], chunk_rows):
+        totals = add_totals(totals, chunk.groupby(['period', 'load_zone', 'technology'],
+                                                  observed=True)[['existing_mw', 'new_mw']].sum())
+    return totals
+
+
+def group_columns(frame, groups):
+    # Columns of technologies summed into one column per group
+    return pd.DataFrame({group: frame.reindex(columns=technologies, fill_value=0.0).sum(axis=1)
+                         for group, technologies in groups.items()}, index=frame.index)
+
+
+def capacity_table(totals, scenario):
+    # Installed capacity per period (GW), all load zones together
+    by_period = totals.groupby(['period', 'technology'], observed=True).sum() / 1e3
+    existing = group_columns(by_period['existing_mw'].unstack('technology'), capacity_groups)
+    new = group_columns(by_period['new_mw'].unstack('technology'), capacity_groups)
+    table = existing[capacity_existing].join(new[capacity_existing].add_suffix('_new'))
+    for group in capacity_total:
+        table[group] = existing[group] + new[group]
+    table['scs'] = scenario
+    table['dummy_existing'] = 0.0
+    table['dummy_new'] = 0.0
+    return table.sort_index().reset_index()[capacity_columns]
+
+
+def nbuilt_tables(totals, scenario):
+    # New capacity per load zone (GW) at the end of the last period, for each df_nbuilt file
+    last = totals.index.get_level_values('period').max()
+    new = totals.xs(last, level='period')['new_mw'].unstack('technology') / 1e3
+    tables = {}
+    for file, columns in nbuilt_files.items():
+        table = group_columns(new, columns).rename_axis('load_zone').reset_index()
+        table['Scenario'] = scenario
+        tables[file] = table[['load_zone'] + list(columns) + ['Scenario']]
+    return tables
+
+
+def transmission_column(path, chunk_rows):
+    # Capacity of every transmission line in the last period (MW)
+    totals = None
+    for chunk in read_chunks(path, ['period', 'transmission_line', 'capacity_mw'], chunk_rows):
+        totals = add_totals(totals, chunk.groupby(['period', 'transmission_line'], observed=True)['capacity_mw'].sum())
+    return totals.xs(totals.index.get_level_values('period').max(), level='period')
+
+
+def ingest_scenario(folder, scenario, chunk_rows):
+    # All the tables of one scenario. Runs in a worker process and returns only the (small) summed tables.
+    path = os.path.join(folder, scenario)
+    capacity = capacity_totals(os.path.join(path, 'capacity.csv'), chunk_rows)
+    summary = pd.read_csv(os.path.join(path, 'summary.csv')).set_index('period').sort_index()
+    return {'generation': generation_table(os.path.join(path, 'dispatch.csv'), scenario, chunk_rows),
+            'capacity': capacity_table(capacity, scenario),
+            'nbuilt': nbuilt_tables(capacity, scenario),
+            'costs': summary['cost_per_mwh'].rename(scenario),
+            'emissions': summary['emissions_mtco2'].rename(scenario),
+            'transmission': transmission_column(os.path.join(path, 'transmission.csv'), chunk_rows).rename(scenario)}
+
+
+def module_data_tables(folder, results):
+    # The csv files of ModuleData, by file name, from the tables of every scenario
+    scenarios = list(results)
+    tables = {'electricity_generation.csv': pd.concat([results[scenario]['generation'] for scenario in scenarios],
+                                                      ignore_index=True),
+              'existing_and_new_capacity.csv': pd.concat([results[scenario]['capacity'] for scenario in scenarios],
+                                                         ignore_index=True)}
+    for file in nbuilt_files:
+        tables[file] = pd.concat([results[scenario]['nbuilt'][file] for scenario in scenarios], ignore_index=True)
+    for name in ['costs', 'emissions']:
+        tables[name + '_lineplot.csv'] = pd.concat([results[scenario][name] for scenario in scenarios],
+                                                   axis=1).rename_axis('period').reset_index()
+
+    # The transmission map keeps the line attributes and has a column of capacities per scenario. Dash.py draws the
+    # Existing Tx maps from the Existing column (see prepare_map_df in module_data.py), so it gets those capacities.
+    lines = pd.read_csv(os.path.join(folder, 'transmission_lines.csv'))
+    capacities = pd.concat([results[scenario]['transmission'] for scenario in scenarios], axis=1)
+    map_df = lines.drop(columns=scenarios, errors='ignore').join(
+        capacities.reindex(lines['transmission_line']).fillna(0).reset_index(drop=True))
+    map_df['Existing'] = map_df['Existing Tx']
+    tables['transmission_map_data.csv'] = map_df
+    return tables
+
+
+def same_values(expected, loaded):
+    return expected.shape == loaded.shape and np.allclose(expected.to_numpy(dtype=float), loaded.to_numpy(dtype=float),
+                                                          equal_nan=True)
+
+
+def check_tables(folder, results):
+    # Prepare the csv files written to folder the way Dash.py loads them, and compare what the data store answers for
+    # every scenario with the ingested tables. Returns the tables that differ.
+    store = FrameStore(load_module_data(folder=folder), checklist_options)
+    problems = []
+    for scenario in checklist_options:
+        result = results[scenario]
+        generation = result['generation'].drop(columns='scs')
+        capacity = result['capacity'].drop(columns='scs')
+        nbuilt = pd.concat([table.set_index('load_zone').drop(columns='Scenario')
+                            for table in result['nbuilt'].values()], axis=1)
+        new_builds = store.new_builds([scenario]).set_index('load_zone')
+        lines = store.transmission([scenario]).set_index('transmission_line')['capacity']
+        loaded = {'generation': (generation, store.generation([scenario])[generation.columns]),
+                  'capacity': (capacity, store.capacity([scenario])[capacity.columns]),
+                  'new builds': (nbuilt, new_builds.loc[nbuilt.index, nbuilt.columns]),
+                  'costs': (result['costs'], store.costs([scenario]).set_index('period')[scenario]),
+                  'emissions': (result['emissions'], store.emissions([scenario]).set_index('period')[scenario]),
+                  'transmission': (result['transmission'].reindex(lines.index).fillna(0), lines)}
+        for table, (expected, actual) in loaded.items():
+            if not same_values(expected.reset_index(drop=True), actual.reset_index(drop=True)):
+                problems.append('{} of {}'.format(table, scenario))
+    return problems
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Make the ModuleData tables from raw model results')
+    parser.add_argument('folder', help='folder of the raw results, with a subfolder per scenario')
+    parser.add_argument('--output', default=module_data_dir, help='folder the csv files are written to')
+    parser.add_argument('--scenarios', nargs='+',
+                        help='scenarios to ingest (all subfolders by default), in the order they are written')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--chunk-rows', type=int, default=500000, help='rows of a raw file read at a time')
+    arguments = parser.parse_args(arguments)
+
+    folder = arguments.folder
+    scenarios = arguments.scenarios or sorted(entry.name for entry in os.scandir(folder) if entry.is_dir())
+    missing = [option for option in checklist_options if option not in scenarios]
+    if missing:
+        parser.error('no results for the checklist options {}'.format(', '.join(missing)))
+    lines = pd.read_csv(os.path.join(folder, 'transmission_lines.csv'), nrows=0).columns
+    missing = [column for column in line_columns if column not in lines]
+    if missing:
+        parser.error('transmission_lines.csv has no {} column'.format(', '.join(missing)))
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=arguments.workers) as executor:
+        results = dict(zip(scenarios, executor.map(ingest_scenario, [folder] * len(scenarios), scenarios,
+                                                   [arguments.chunk_rows] * len(scenarios))))
+
+    staging = os.path.join(arguments.output, '.ingest-{}'.format(os.getpid()))
+    os.makedirs(staging)
+    try:
+        tables = module_data_tables(folder, results)
+        for file, table in tables.items():
+            table.to_csv(os.path.join(staging, file), index=False)
+        problems = check_tables(staging, results)
+        if problems:
+            raise SystemExit('The prepared tables differ from the ingested ones ({}), {} was not changed'.format(
+                ', '.join(problems), arguments.output))
+        for file in tables:
+            os.replace(os.path.join(staging, file), os.path.join(arguments.output, file))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    print('Ingested {} scenarios into {} in {:.1f} s'.format(len(scenarios), arguments.output,
+                                                             time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
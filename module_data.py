@@ -0,0 +1,223 @@
+# Loading and preparing the ModuleData tables used by Dash.py
+# The prepared tables are saved to a columnar binary cache (one .npy file per column, text columns stored as
+# categorical codes) in ModuleData/.cache. The cache of a table is rebuilt only when one of its csv files changes,
+# so starting the module is mostly memory-mapping the cached columns instead of parsing and transforming csv files.
+# Run this file directly to (re)build the cache ahead of time: python module_data.py
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+module_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ModuleData')
+cache_dir = os.path.join(module_data_dir, '.cache')
+cache_format = 1
+
+# Checklist Options
+checklist_options = ['Static Costs', 'Existing Tx', 'Planned Tx', 'Reference', 'Coal Ret. 55y',
+                     'Coal Ret. 45y', 'Clean 80%']
+
+# Csv files each prepared table is made from
+frame_sources = {'generation_df': ['electricity_generation.csv'],
+                 'capacity_df': ['existing_and_new_capacity.csv'],
+                 'costs_lineplot': ['costs_lineplot.csv'],
+                 'emissions_lineplot': ['emissions_lineplot.csv'],
+                 'df_nbuilt': ['df_nbuilt_hydro.csv', 'df_nbuilt_vre.csv', 'df_nbuilt_fossil.csv'],
+                 'map_df': ['transmission_map_data.csv']}
+
+# Bin-edge table for transmission maps: the upper edge (MW) of each magnitude range, with its legend name and width
+# A capacity falls into the first range whose upper edge it does not exceed
+transmission_bins = pd.DataFrame({'upper': [0, 100, 1000, 2000, 4000, np.inf],
+                                  'name': ['none', '1 - 100', '101 - 1000', '1001 - 2000', '2001 - 4000',
+                                           '4001 - 6042'],
+                                  'width': [0, 2, 3, 4, 6, 8]})
+legendgroupdict = transmission_bins[['name', 'width']].to_dict('index')
+
+
+def source_files(*frames, folder=module_data_dir):
+    # Paths of the csv files the given prepared tables are made from
+    return [os.path.join(folder, file) for frame in frames for file in frame_sources[frame]]
+
+
+def classify_transmission(capacities):
+    # Legend group of every value in an array of capacities, all scenarios at once
+    return np.searchsorted(transmission_bins['upper'].to_numpy()[:-1], capacities, side='left')
+
+
+def prepare_df_nbuilt(df_nbuilt_hydro, df_nbuilt_vre, df_nbuilt_fossil):
+    # Data transformation for country bar plots
+    df_nbuilt = df_nbuilt_hydro.merge(
+        df_nbuilt_vre, on=['load_zone', 'Scenario'], how='left').merge(
+        df_nbuilt_fossil, on=['load_zone', 'Scenario'], how='left')[
+        ['load_zone', 'Scenario', 'Hydro', 'Wind', 'SolarPV', 'SolarCSP', 'Battery', 'Coal', 'Gas']]
+    return df_nbuilt.replace({'Optimal Tx (Reference)': 'Reference', 'Static costs': 'Static Costs',
+                              'Coal ret. 55y': 'Coal Ret. 55y', 'Coal ret. 45y': 'Coal Ret. 45y'})
+
+
+def prepare_map_df(map_df):
+    # Data transformation for transmission maps
+    map_df['Existing Tx'] = map_df['Existing']
+    return map_df.join(pd.DataFrame(classify_transmission(map_df[checklist_options].to_numpy()),
+                                    columns=[scenario + '_legendgroup' for scenario in checklist_options],
+                                    index=map_df.index))
+
+
+def prepare_frame(name, folder=module_data_dir):
+    # Read the csv files of one table and apply its transformation
+    frames = [pd.read_csv(path) for path in source_files(name, folder=folder)]
+    if name == 'df_nbuilt':
+        frame = prepare_df_nbuilt(*frames)
+    elif name == 'map_df':
+        frame = prepare_map_df(*frames)
+    else:
+        frame = frames[0]
+    # Text columns (scenarios, zones, line names) are stored as categoricals
+    for column in frame.columns:
+        if not pd.api.types.is_numeric_dtype(frame[column]):
+            frame[column] = frame[column].astype('category')
+    return frame.reset_index(drop=True)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_stamps(name, hashes=True):
+    stamps = {}
+    for path in source_files(name):
+        stat = os.stat(path)
+        stamps[os.path.basename(path)] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+                                          'sha256': file_hash(path) if hashes else None}
+    return stamps
+
+
+def current_stamps(name, recorded=None):
+    # Stamps of the csv files of a table, reusing the hashes of the recorded stamps: a file is only hashed again when
+    # its modification time or size changed
+    stamps = source_stamps(name, hashes=False)
+    for file, stamp in stamps.items():
+        old = (recorded or {}).get(file)
+        if old is not None and (old['mtime_ns'], old['size']) == (stamp['mtime_ns'], stamp['size']):
+            stamp['sha256'] = old['sha256']
+        else:
+            stamp['sha256'] = file_hash(os.path.join(module_data_dir, file))
+    return stamps
+
+
+def same_contents(stamps, recorded):
+    return (recorded is not None and set(stamps) == set(recorded) and
+            all(stamp['sha256'] == recorded[file]['sha256'] for file, stamp in stamps.items()))
+
+
+def write_json(path, content):
+    # Write to a temporary file first, so readers never see a half written file
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'w') as file:
+        json.dump(content, file, indent=1)
+    os.replace(temporary, path)
+
+
+def save_frame(name, frame, stamps):
+    os.makedirs(cache_dir, exist_ok=True)
+    columns = []
+    for i, column in enumerate(frame.columns):
+        values = frame[column]
+        file = '{}.{}.npy'.format(name, i)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            array = values.cat.codes.to_numpy()
+            entry = {'name': column, 'file': file, 'categories': values.cat.categories.tolist()}
+        else:
+            array = values.to_numpy()
+            entry = {'name': column, 'file': file}
+        temporary = os.path.join(cache_dir, '{}.{}.tmp.npy'.format(file, os.getpid()))
+        np.save(temporary, array, allow_pickle=False)
+        os.replace(temporary, os.path.join(cache_dir, file))
+        columns.append(entry)
+    # The manifest is written last, so it only ever points at complete column files
+    write_json(os.path.join(cache_dir, name + '.json'),
+               {'format': cache_format, 'sources': stamps, 'columns': columns, 'rows': len(frame)})
+
+
+def read_manifest(name):
+    try:
+        with open(os.path.join(cache_dir, name + '.json')) as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+    return manifest if manifest.get('format') == cache_format else None
+
+
+def stamps_unchanged(name, cached):
+    # True if the csv files of a table still match the stamps recorded when it was cached: the same modification time
+    # and size, or failing that, the same contents (files that were touched or copied without being changed)
+    if set(cached) != set(frame_sources[name]):
+        return False
+    for file, stamp in source_stamps(name, hashes=False).items():
+        if (stamp['mtime_ns'], stamp['size']) == (cached[file]['mtime_ns'], cached[file]['size']):
+            continue
+        if file_hash(os.path.join(module_data_dir, file)) != cached[file]['sha256']:
+            return False
+    return True
+
+
+def cache_is_current(name, manifest):
+    if manifest is None or not stamps_unchanged(name, manifest['sources']):
+        return False
+    # Record the new modification times of touched files, so their contents are not hashed again next time
+    stamps = source_stamps(name, hashes=False)
+    if any(stamps[file]['mtime_ns'] != manifest['sources'][file]['mtime_ns'] for file in stamps):
+        write_json(os.path.join(cache_dir, name + '.json'),
+                   dict(manifest, sources=current_stamps(name, manifest['sources'])))
+    return True
+
+
+def load_frame(manifest):
+    # Numeric columns are memory-mapped, categorical ones are rebuilt from their memory-mapped codes
+    columns = {}
+    for entry in manifest['columns']:
+        array = np.load(os.path.join(cache_dir, entry['file']), mmap_mode='r', allow_pickle=False)
+        if 'categories' in entry:
+            columns[entry['name']] = pd.Categorical.from_codes(array, categories=entry['categories'])
+        else:
+            columns[entry['name']] = array
+    return pd.DataFrame(columns, index=pd.RangeIndex(manifest['rows']), copy=False)
+
+
+def load_prepared(name, use_cache=True):
+    # Prepared table and the stamps of the csv files it was made from. With the cache, both come from the cache files,
+    # so csv files that didn't change since the cache was built are not read at all.
+    if not use_cache:
+        stamps = source_stamps(name)
+        return prepare_frame(name), stamps
+    if not cache_is_current(name, read_manifest(name)):
+        stamps = source_stamps(name)
+        save_frame(name, prepare_frame(name), stamps)
+    manifest = read_manifest(name)
+    return load_frame(manifest), manifest['sources']
+
+
+def load_prepared_frame(name, use_cache=True):
+    # Prepared table from the binary cache, rebuilding the cache first if its csv files changed
+    return load_prepared(name, use_cache)[0]
+
+
+def load_module_data(use_cache=None, folder=module_data_dir):
+    # All prepared tables used by Dash.py. The cache can be turned off with CETLAB_DATA_CACHE=0.
+    # The tables of another folder (ingest.py checks the files it wrote this way) are always prepared from the csv files.
+    if folder != module_data_dir:
+        return {name: prepare_frame(name, folder) for name in frame_sources}
+    if use_cache is None:
+        use_cache = os.environ.get('CETLAB_DATA_CACHE', '1') != '0'
+    return {name: load_prepared_frame(name, use_cache) for name in frame_sources}
+
+
+if __name__ == '__main__':
+    for frame_name in frame_sources:
+        status = 'up to date' if cache_is_current(frame_name, read_manifest(frame_name)) else 'rebuilt'
+        load_prepared_frame(frame_name)
+        print('{}: {}'.format(frame_name, status))
@@ -0,0 +1,368 @@
+# Data access for the Dash.py callbacks
+# The callbacks never filter whole dataframes themselves, they ask a store for the rows of the selected scenarios.
+# FrameStore keeps the prepared tables in memory (fine for a handful of scenarios), SQLiteStore keeps them in an
+# indexed SQLite database so only the selected slices are ever read into memory. Both return the same dataframes.
+# The store is picked with the CETLAB_DATA_STORE environment variable ('memory' or 'sqlite').
+# Dash.py uses it through a ReloadingStore, which watches the csv files and swaps in a new store when they change.
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+import pandas as pd
+
+import module_data
+
+database_path = os.path.join(module_data.cache_dir, 'scenarios.sqlite')
+
+# Columns of the transmission lines shared by every scenario
+line_columns = ['ID', 'transmission_line', 'x_start', 'y_start', 'x_end', 'y_end']
+
+
+def transmission_long(map_df, scenarios):
+    # One row per scenario and line, with the capacity and legend group of the line in that scenario
+    return pd.concat([map_df[line_columns].assign(scenario=scenario, capacity=map_df[scenario],
+                                                  legendgroup=map_df[scenario + '_legendgroup'])
+                      for scenario in scenarios], ignore_index=True)
+
+
+def wide_by_period(long, scenarios):
+    # Costs and emissions go back to the shape of the csv files: a period column and one column per scenario
+    wide = long.pivot(index='period', columns='scenario', values='value')
+    return wide.reindex(columns=scenarios).reset_index().rename_axis(columns=None)
+
+
+class FrameStore:
+    # Prepared tables held in memory, filtered with pandas. The long transmission table can be passed in when map_df
+    # is the same as in an earlier store.
+    def __init__(self, frames, scenarios=None, transmission_lines=None):
+        self.scenarios = list(scenarios if scenarios is not None else module_data.checklist_options)
+        self.frames = frames
+        if transmission_lines is None:
+            transmission_lines = transmission_long(frames['map_df'], self.scenarios)
+        self.transmission_lines = transmission_lines
+
+    def capacity(self, scenarios):
+        capacity_df = self.frames['capacity_df']
+        return capacity_df[capacity_df['scs'].isin(scenarios)]
+
+    def generation(self, scenarios):
+        generation_df = self.frames['generation_df']
+        return generation_df[generation_df['scs'].isin(scenarios)]
+
+    def costs(self, scenarios):
+        return self.frames['costs_lineplot'][['period'] + list(scenarios)]
+
+    def emissions(self, scenarios):
+        return self.frames['emissions_lineplot'][['period'] + list(scenarios)]
+
+    def new_builds(self, scenarios):
+        df_nbuilt = self.frames['df_nbuilt']
+        return df_nbuilt[df_nbuilt['Scenario'].isin(scenarios)]
+
+    def transmission(self, scenarios):
+        lines = self.transmission_lines
+        return lines[lines['scenario'].isin(scenarios)]
+
+
+class SQLiteStore:
+    # Prepared tables in an SQLite database indexed by scenario, period and load zone. Every query only reads the
+    # rows of the selected scenarios, in the same order as the prepared tables.
+    def __init__(self, path=database_path, scenarios=None):
+        self.scenarios = list(scenarios if scenarios is not None else module_data.checklist_options)
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # SQLite connections can't be shared between threads or forked processes, so every thread of every worker
+        # process opens its own (read only)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True, check_same_thread=False)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _query(self, table, column, scenarios):
+        placeholders = ', '.join('?' * len(scenarios))
+        sql = 'SELECT * FROM "{}" WHERE "{}" IN ({}) ORDER BY rowid'.format(table, column, placeholders)
+        return pd.read_sql_query(sql, self._connection(), params=list(scenarios))
+
+    def capacity(self, scenarios):
+        return self._query('capacity', 'scs', scenarios)
+
+    def generation(self, scenarios):
+        return self._query('generation', 'scs', scenarios)
+
+    def costs(self, scenarios):
+        return wide_by_period(self._query('costs', 'scenario', scenarios), scenarios)
+
+    def emissions(self, scenarios):
+        return wide_by_period(self._query('emissions', 'scenario', scenarios), scenarios)
+
+    def new_builds(self, scenarios):
+        return self._query('new_builds', 'Scenario', scenarios)
+
+    def transmission(self, scenarios):
+        placeholders = ', '.join('?' * len(scenarios))
+        sql = ('SELECT {}, t.scenario, t.capacity, t.legendgroup FROM transmission AS t '
+               'JOIN transmission_lines AS l ON l.ID = t.ID WHERE t.scenario IN ({}) ORDER BY t.rowid'
+               .format(', '.join('l."{}"'.format(column) for column in line_columns), placeholders))
+        return pd.read_sql_query(sql, self._connection(), params=list(scenarios))
+
+
+def long_by_period(frame, scenarios):
+    return frame.melt(id_vars='period', value_vars=scenarios, var_name='scenario', value_name='value')
+
+
+def database_tables(name, frame, scenarios):
+    # Tables of the database made from one prepared table
+    if name == 'capacity_df':
+        return {'capacity': frame}
+    if name == 'generation_df':
+        return {'generation': frame}
+    if name == 'costs_lineplot':
+        return {'costs': long_by_period(frame, scenarios)}
+    if name == 'emissions_lineplot':
+        return {'emissions': long_by_period(frame, scenarios)}
+    if name == 'df_nbuilt':
+        return {'new_builds': frame}
+    return {'transmission_lines': frame[line_columns],
+            'transmission': transmission_long(frame, scenarios)[['ID', 'scenario', 'capacity', 'legendgroup']]}
+
+
+table_indexes = {'capacity': 'CREATE INDEX capacity_scenario ON capacity (scs, period)',
+                 'generation': 'CREATE INDEX generation_scenario ON generation (scs, period)',
+                 'costs': 'CREATE INDEX costs_scenario ON costs (scenario, period)',
+                 'emissions': 'CREATE INDEX emissions_scenario ON emissions (scenario, period)',
+                 'new_builds': 'CREATE INDEX new_builds_scenario ON new_builds (Scenario, load_zone)',
+                 'transmission_lines': 'CREATE UNIQUE INDEX transmission_lines_id ON transmission_lines (ID)',
+                 'transmission': 'CREATE INDEX transmission_scenario ON transmission (scenario, legendgroup)'}
+
+
+def column_type(column):
+    if pd.api.types.is_bool_dtype(column) or pd.api.types.is_integer_dtype(column):
+        return 'INTEGER'
+    return 'REAL' if pd.api.types.is_float_dtype(column) else 'TEXT'
+
+
+def write_table(connection, table, frame):
+    # Replace a table of the database with the rows of a dataframe. Nothing is committed, so the caller decides what
+    # goes into a transaction (pandas' to_sql commits by itself, which is why it isn't used).
+    frame = frame.apply(lambda column: column.astype(object) if isinstance(column.dtype, pd.CategoricalDtype)
+                        else column)
+    connection.execute('DROP TABLE IF EXISTS "{}"'.format(table))
+    connection.execute('CREATE TABLE "{}" ({})'.format(
+        table, ', '.join('"{}" {}'.format(column, column_type(frame[column])) for column in frame.columns)))
+    rows = frame.astype(object).where(frame.notna(), None).itertuples(index=False, name=None)
+    connection.executemany('INSERT INTO "{}" VALUES ({})'.format(table, ', '.join('?' * len(frame.columns))), rows)
+    connection.execute(table_indexes[table])
+
+
+def write_frames(connection, frames, stamps, scenarios):
+    # Write the tables made from the given prepared tables, and record the stamps of the csv files they come from
+    for name, frame in frames.items():
+        for table, rows in database_tables(name, frame, scenarios).items():
+            write_table(connection, table, rows)
+    connection.executemany('INSERT OR REPLACE INTO sources VALUES (?, ?)',
+                           [(name, json.dumps(stamp)) for name, stamp in stamps.items()])
+
+
+def build_database(frames, path=database_path, scenarios=None, stamps=None):
+    # Write the prepared tables into a new database, which then replaces the old one in a single step
+    scenarios = list(scenarios if scenarios is not None else module_data.checklist_options)
+    if stamps is None:
+        stamps = {name: module_data.source_stamps(name) for name in module_data.frame_sources}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    connection = sqlite3.connect(temporary, isolation_level=None)
+    try:
+        connection.execute('BEGIN')
+        connection.execute('CREATE TABLE sources (frame TEXT PRIMARY KEY, stamps TEXT)')
+        write_frames(connection, frames, stamps, scenarios)
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+    os.replace(temporary, path)
+
+
+def database_sources(path=database_path):
+    # Stamps of the csv files the tables of a database were made from, or None if there is no usable database
+    if not os.path.exists(path):
+        return None
+    connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        recorded = {name: json.loads(stamps) for name, stamps in connection.execute('SELECT frame, stamps FROM sources')}
+    except sqlite3.DatabaseError:
+        return None
+    finally:
+        connection.close()
+    return recorded if set(recorded) == set(module_data.frame_sources) else None
+
+
+def update_database(use_cache=True, path=database_path, names=()):
+    # Bring the database up to date with the csv files, and return the stamps of the csv files its tables are made
+    # from. Only the prepared tables with changed csv files (and the ones in names) are loaded, and their database
+    # tables are written again in a single transaction, so queries see either the old or the new tables. The write
+    # lock of the transaction also means only one process does this at a time: when every worker of the app notices
+    # the same change, the first one writes the tables, and the others wait for it and find them up to date.
+    # A missing or unreadable database is built from scratch.
+    if database_sources(path) is None:
+        frames, stamps = {}, {}
+        for name in module_data.frame_sources:
+            frames[name], stamps[name] = module_data.load_prepared(name, use_cache)
+        build_database(frames, path, stamps=stamps)
+        return stamps
+
+    connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+    try:
+        # Written pages stay in memory until the commit, so queries of other processes aren't locked out before it
+        connection.execute('PRAGMA cache_size = -262144')
+        connection.execute('BEGIN IMMEDIATE')
+        recorded = {name: json.loads(stamps) for name, stamps in connection.execute('SELECT frame, stamps FROM sources')}
+        frames, stamps = {}, {}
+        for name in module_data.frame_sources:
+            stamps[name] = module_data.current_stamps(name, recorded.get(name))
+            if name in names or not module_data.same_contents(stamps[name], recorded.get(name)):
+                frames[name], stamps[name] = module_data.load_prepared(name, use_cache)
+        changed = {name: stamp for name, stamp in stamps.items() if stamp != recorded.get(name)}
+        if frames or changed:
+            write_frames(connection, frames, changed, module_data.checklist_options)
+        connection.execute('COMMIT')
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+    return stamps
+
+
+class ReloadingStore:
+    # The store used by Dash.py. It answers with the store of the tables that are loaded, and follows changes to the
+    # csv files: only the tables made from changed files are prepared again, a new store is built from them and the
+    # unchanged tables, and it replaces the old store in a single assignment, so every call is answered by either the
+    # old or the new data. Functions added with on_reload are then called with the names of the reloaded tables.
+    def __init__(self, kind):
+        if kind not in ('memory', 'sqlite'):
+            raise ValueError("Unknown data store {!r}, expected 'memory' or 'sqlite'".format(kind))
+        self.kind = kind
+        self.use_cache = os.environ.get('CETLAB_DATA_CACHE', '1') != '0'
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._pending = {}
+        self._watcher_pid = None
+        # The stamps (with the hashes) of the loaded csv files come from the binary cache or the database, so csv files
+        # that didn't change aren't read. The SQLite store only loads the prepared tables it has to write again.
+        self.frames = {}
+        if kind == 'sqlite':
+            self.stamps = update_database(self.use_cache)
+        else:
+            self.stamps = {}
+            for name in module_data.frame_sources:
+                self.frames[name], self.stamps[name] = module_data.load_prepared(name, self.use_cache)
+        self.store = self._open(self.frames)
+
+    def _open(self, frames, previous=None):
+        if self.kind == 'sqlite':
+            return SQLiteStore()
+        return FrameStore(frames, transmission_lines=getattr(previous, 'transmission_lines', None))
+
+    def __getattr__(self, name):
+        # Queries go to the current store
+        if name == 'store':
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+    def version(self, paths):
+        # Contents of the given csv files as they were when the loaded tables were made from them. The figure cache
+        # uses this instead of the files on disk, so its figures always match the data that is loaded.
+        files = {os.path.basename(path) for path in paths}
+        return tuple(sorted((file, stamp['sha256'])
+                            for stamps in self.stamps.values() for file, stamp in stamps.items() if file in files))
+
+    def on_reload(self, listener):
+        self._listeners.append(listener)
+
+    def changed_frames(self):
+        # Tables with csv files that changed since they were loaded. A change is only picked up once the files are the
+        # same at two checks in a row, so a file that is still being copied isn't read half written.
+        changed = []
+        for name in module_data.frame_sources:
+            recorded = self.stamps[name]
+            current = module_data.source_stamps(name, hashes=False)
+            if all((stamp['mtime_ns'], stamp['size']) == (recorded[file]['mtime_ns'], recorded[file]['size'])
+                   for file, stamp in current.items()):
+                self._pending.pop(name, None)
+                continue
+            if self._pending.get(name) != current:
+                self._pending[name] = current
+                continue
+            self._pending.pop(name, None)
+            stamps = module_data.current_stamps(name, recorded)
+            if module_data.same_contents(stamps, recorded):
+                # Touched or copied without changes, remember the new modification times so it isn't hashed again
+                self.stamps[name] = stamps
+                continue
+            changed.append(name)
+        return changed
+
+    def reload(self, names=None):
+        # Prepare the given tables again (by default the ones with changed files) and swap in a new store
+        with self._lock:
+            forced = names or ()
+            if names is None:
+                names = self.changed_frames()
+            if not names:
+                return []
+            if self.kind == 'sqlite':
+                # The database is shared by every worker, see update_database. Changed tables are only written by the
+                # first worker to get to them, the given ones are always written again.
+                stamps = update_database(self.use_cache, names=forced)
+                names = [name for name in module_data.frame_sources
+                         if name in names or not module_data.same_contents(stamps[name], self.stamps[name])]
+                frames = self.frames
+            else:
+                frames = dict(self.frames)
+                stamps = dict(self.stamps)
+                for name in names:
+                    frames[name], stamps[name] = module_data.load_prepared(name, self.use_cache)
+            store = self._open(frames, None if 'map_df' in names else self.store)
+            self.frames = frames
+            self.store = store
+            self.stamps = stamps
+            for name in names:
+                self._pending.pop(name, None)
+        for listener in self._listeners:
+            listener(names)
+        return names
+
+    def watch(self, interval):
+        # Check the csv files every interval seconds in a background thread. Threads don't survive a fork, so this is
+        # called again in every worker process (it does nothing if this process is already watching).
+        if interval <= 0 or self._watcher_pid == os.getpid():
+            return
+        self._watcher_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload()
+                except Exception:
+                    # Keep the data that is loaded, and try again at the next check
+                    traceback.print_exc()
+
+        threading.Thread(target=run, name='module-data-watcher', daemon=True).start()
+
+
+def open_data_store(kind=None):
+    # The tables of the SQLite database are written again when a csv file changed since they were made, and the whole
+    # database is built when it is missing
+    if kind is None:
+        kind = os.environ.get('CETLAB_DATA_STORE', 'memory')
+    return ReloadingStore(kind)
@@ -0,0 +1,72 @@
+# Checks of the Patch updates sent by the server mode callbacks of Dash.py
+# A Patch applied to the figure drawn for one selection has to give the figure drawn from scratch for the next one.
+# Run with: python -m pytest test_patch_updates.py
+import itertools
+import json
+import random
+
+import plotly.io.json as plotly_json
+import pytest
+
+import Dash
+
+options = Dash.checklist_options
+selections = [list(selection) for count in range(len(options) + 1)
+              for selection in itertools.combinations(options, count)]
+
+
+def as_json(value):
+    return json.loads(plotly_json.to_json_plotly(value))
+
+
+def apply_patch(figure, patch):
+    # The operations Dash.py sends, applied the way dash-renderer applies them
+    for operation in as_json(patch)['operations']:
+        location = operation['location']
+        target = figure
+        for key in location[:-1] if operation['operation'] in ('Assign', 'Delete') else location:
+            target = target[key]
+        if operation['operation'] == 'Assign':
+            target[location[-1]] = operation['params']['value']
+        elif operation['operation'] == 'Delete':
+            del target[location[-1]]
+        elif operation['operation'] == 'Insert':
+            target.insert(operation['params']['index'], operation['params']['value'])
+        else:
+            raise ValueError('Unexpected patch operation {}'.format(operation['operation']))
+    return figure
+
+
+def toggles(count=40, seed=0):
+    # Pairs of selections: every single scenario unticked from the full selection, then random changes
+    pairs = [(list(options), [option for option in options if option != unticked]) for unticked in options]
+    generator = random.Random(seed)
+    while len(pairs) < count:
+        old, new = generator.choice(selections), generator.choice(selections)
+        if old != new:
+            pairs.append((old, new))
+    return pairs
+
+
+@pytest.mark.parametrize('old, new', toggles())
+def test_generation_patch(old, new):
+    drawn = Dash.update_generation(old, 'generation', None)
+    patches = Dash.update_generation(new, 'generation', drawn[3])
+    for figure, patch, rebuilt in zip(drawn[:3], patches[:3], Dash.plot_generation(new)):
+        assert apply_patch(as_json(figure), patch) == as_json(rebuilt)
+
+
+@pytest.mark.parametrize('rank_by', ['Unranked', 'Total'])
+@pytest.mark.parametrize('old, new', toggles())
+def test_countries_patch(old, new, rank_by):
+    view = (rank_by, Dash.country_page_size, 1)
+    figure, rendered, page_count, pager = Dash.update_countries(old, 'countries', *view, None)
+    patch = Dash.update_countries(new, 'countries', *view, rendered)[0]
+    assert apply_patch(as_json(figure), patch) == as_json(Dash.update_countries_barplot(new, *view))
+
+
+@pytest.mark.parametrize('old, new', toggles())
+def test_transmission_maps_patch(old, new):
+    figure, rendered = Dash.update_transmission_maps(old, 'transmission_maps', None)
+    patch = Dash.update_transmission_maps(new, 'transmission_maps', rendered)[0]
+    assert apply_patch(as_json(figure), patch) == as_json(Dash.update_fig4(new))
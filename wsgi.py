@@ -0,0 +1,27 @@
+# Production entry point for Dash.py
+# `python Dash.py` runs Flask's development server, which handles one request at a time. For production, run the app
+# in a multi-process WSGI server instead, with the app loaded once before the workers are started:
+#   gunicorn --config gunicorn.conf.py 'wsgi:create_app()'
+import gc
+import os
+
+
+def create_app(figure_cache='shared', worker_stats='shared'):
+    # Build the Dash app and return its Flask server. Everything here runs once, in the main process of a
+    # preloading server: the ModuleData tables are prepared (or memory-mapped from the binary cache) and the data
+    # store is opened before any worker is forked, so the workers share them copy-on-write instead of each loading
+    # its own copy. The figure cache is shared between the workers through an SQLite file (see figure_cache.py), and
+    # so are the counters of the /metrics and /figure-cache endpoints (see callback_metrics.py).
+    os.environ.setdefault('CETLAB_FIGURE_CACHE', figure_cache)
+    os.environ.setdefault('CETLAB_WORKER_STATS', worker_stats)
+    import Dash
+
+    # The counters of the workers of an earlier run are dropped, so the totals start from zero with the app
+    if Dash.worker_stats is not None:
+        Dash.worker_stats.clear()
+
+    # Objects created so far are moved out of the garbage collector's reach, so that collections in the workers
+    # don't write to (and so copy) the memory pages they share with the main process
+    gc.collect()
+    gc.freeze()
+    return Dash.app.server